@@ -1,12 +1,34 @@
 #!/usr/bin/python3
 
-import openai
+# the openai sdk (pydantic, httpx, ...) takes longer to import than everything else here put together,
+# so it's only imported once a request is actually about to be sent (see make_client)
 import sys
 import os
 import json
 import glob
 import argparse
 import asyncio
+import time
+import hashlib
+
+MODEL = "gpt-4o"
+# everything besides the messages that changes the reply, also part of the response cache key
+PARAMS = {
+    "temperature": 1,
+    "max_tokens": 2048,
+    "top_p": 1,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+}
+
+# response cache (--cache): entries older than this are never served, and past this total size the oldest go first
+CACHE_MAX_AGE = 7 * 24 * 3600
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# batch mode (--batch): requests in flight at most, unless --concurrency says otherwise,
+# and how many times one prompt is retried after a 429 before it's reported as failed
+BATCH_CONCURRENCY = 8
+BATCH_MAX_RETRIES = 5
 
 
 # doesn't include the sys prompt, just the user message and context
@@ -49,100 +71,755 @@ def fmt_response(resp: str) -> dict:
         ]
     }
 
-async def ask_openai(client: openai.OpenAI, messages: list[dict]) -> str:
-    stream = client.chat.completions.create(
-        model="gpt-4o",
+def print_chunk(text: str):
+    print(text, end="", flush=True)
+
+# streams the reply to stdout (or to `emit`) as it arrives. if `stats` is given it's filled in with the timings:
+# time to first token, total latency, and completion tokens (from the usage chunk at the end of the stream)
+async def ask_openai(client: "openai.AsyncOpenAI", messages: list[dict], stats: dict = None,
+                     emit=print_chunk) -> str:
+    t_start = time.monotonic()
+    t_first = None
+    usage = None
+    stream = await client.chat.completions.create(
+        model=MODEL,
         messages=messages,
         stream=True,
-        temperature=1,
-        max_tokens=2048,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
+        stream_options={"include_usage": True},
+        **PARAMS,
     )
-    
-    response = ""
+
+    chunks = []
     try:
-        for chunk in stream:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            # the usage chunk has no choices
+            if not chunk.choices:
+                continue
             resp_chunk = chunk.choices[0].delta.content
             if resp_chunk is not None:
-                print(resp_chunk, end="")
-                response += resp_chunk
-        return response
+                if t_first is None:
+                    t_first = time.monotonic()
+                emit(resp_chunk)
+                chunks.append(resp_chunk)
 
+    # stderr, stdout is the reply (or batch mode's jsonl)
     except asyncio.CancelledError:
-        print("<CTRL-C> exiting...")
+        print("<CTRL-C> exiting...", file=sys.stderr)
         return None
 
-def save_convo(buffer_filepath: str, conversation: dict):
-    with open(buffer_filepath, 'w') as f:
-        json.dump(conversation, f)
+    if stats is not None:
+        t_end = time.monotonic()
+        stats["ttft"] = t_first - t_start if t_first is not None else None
+        stats["total"] = t_end - t_start
+        stats["tokens"] = usage.completion_tokens if usage is not None else len(chunks)
+        stats["gen_time"] = t_end - t_first if t_first is not None else None
+    return "".join(chunks)
 
-def load_convo(buffer_filepath: str) -> dict:
-    with open(buffer_filepath, 'r') as f:
-        return json.load(f)
+# one line for stderr, so it never ends up mixed into a piped reply
+def fmt_stats(stats: dict) -> str:
+    if stats.get("cached"):
+        return f"[stats] cache hit, total {stats['total']:.3f}s"
+    ttft = f"{stats['ttft']:.3f}s" if stats["ttft"] is not None else "n/a"
+    tok_s = f"{stats['tokens'] / stats['gen_time']:.1f}" if stats["gen_time"] else "n/a"
+    return f"[stats] ttft {ttft}, {stats['tokens']} tokens at {tok_s} tok/s, total {stats['total']:.3f}s"
 
-async def main():
+# max_retries=None keeps the sdk's own retries, batch mode turns them off to see (and adapt to) the 429s itself
+def make_client(max_retries: int = None) -> "openai.AsyncOpenAI":
+    import openai
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        sys.exit("error: openai API key not found")
+    openai.api_key = api_key
+    if max_retries is not None:
+        return openai.AsyncOpenAI(max_retries=max_retries)
+    return openai.AsyncOpenAI()
 
-    SYSTEM_PROMPT = "You are a helpful assistant that provides concise replies to the user's query."
+# `ask --daemon` keeps one client (and its connection pool) warm and answers requests on a unix socket, so
+# invocations that find the socket skip importing openai and setting up tls altogether.
+# one json line in ({"messages": [...], "stats": bool}), json lines out: {"delta": str}... then
+# {"done": true, "response": str, "stats": dict} or {"error": str}.
+# a request carries its context files, so lines can be far longer than asyncio's default 64 KiB
+DAEMON_LINE_LIMIT = 256 * 1024 * 1024
 
-    home_dir = os.environ['HOME']
-    BUFFER_FILEPATH = os.path.join(home_dir, ".ask", "buffer.json")
+async def serve_daemon(sock_path: str):
+    client = make_client()
 
-    api_key = os.environ['OPENAI_API_KEY']
-    if not api_key:
-        return "error: openai API key not found"
+    async def handle(reader, writer):
+        try:
+            req = json.loads(await reader.readline())
+            stats = {} if req.get("stats") else None
+            emit = lambda text: writer.write((json.dumps({"delta": text}) + "\n").encode())
+            response = await ask_openai(client, req["messages"], stats, emit)
+            writer.write((json.dumps({"done": True, "response": response, "stats": stats}) + "\n").encode())
+        except Exception as e:
+            writer.write((json.dumps({"error": repr(e)}) + "\n").encode())
+        await writer.drain()
+        writer.close()
 
-    openai.api_key = api_key
-    client = openai.OpenAI()
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+    server = await asyncio.start_unix_server(handle, path=sock_path, limit=DAEMON_LINE_LIMIT)
+    print(f"listening on {sock_path}")
+    async with server:
+        await server.serve_forever()
+
+# the client side of serve_daemon, same contract as ask_openai.
+# raises ConnectionError / FileNotFoundError if there's no daemon listening, and ConnectionError too if the daemon
+# fails before printing anything (so the caller can just ask directly). past that point a failure is a RuntimeError
+async def ask_daemon(sock_path: str, messages: list[dict], stats: dict = None) -> str:
+    reader, writer = await asyncio.open_unix_connection(sock_path, limit=DAEMON_LINE_LIMIT)
+    printed = False
+    try:
+        writer.write((json.dumps({"messages": messages, "stats": stats is not None}) + "\n").encode())
+        await writer.drain()
+        async for line in reader:
+            msg = json.loads(line)
+            if "delta" in msg:
+                print_chunk(msg["delta"])
+                printed = True
+            elif "error" in msg:
+                raise (RuntimeError if printed else ConnectionError)(f"daemon: {msg['error']}")
+            else:
+                if stats is not None:
+                    stats.update(msg["stats"])
+                return msg["response"]
+        raise (RuntimeError if printed else ConnectionError)("daemon: connection closed mid-reply")
+    finally:
+        writer.close()
+
+# the cache key covers everything that goes into the request: model, params, and the messages
+# (system prompt, history, and the new message with its context files pasted in)
+def cache_key(messages: list[dict]) -> str:
+    blob = json.dumps({"model": MODEL, "params": PARAMS, "messages": messages}, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def cache_get(cache_dir: str, key: str) -> str:
+    path = os.path.join(cache_dir, key + ".json")
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_MAX_AGE:
+            os.remove(path)
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)["response"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return None
+
+def cache_put(cache_dir: str, key: str, response: str):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + ".json")
+    # write + rename so a concurrent ask never reads half an entry
+    with open(path + ".tmp", 'w') as f:
+        json.dump({"model": MODEL, "response": response}, f)
+    os.replace(path + ".tmp", path)
+    evict_cache(cache_dir)
+
+# drops expired entries, then the oldest ones until the cache fits in CACHE_MAX_BYTES
+def evict_cache(cache_dir: str):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".json"):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    now = time.time()
+    for mtime, size, path in entries:
+        if now - mtime <= CACHE_MAX_AGE and total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# a cache hit goes out through the same output path as a live reply, a line at a time
+def replay_response(response: str, stats: dict = None) -> str:
+    t_start = time.monotonic()
+    for line in response.splitlines(keepends=True):
+        print_chunk(line)
+    if stats is not None:
+        stats.update(cached=True, total=time.monotonic() - t_start)
+    return response
+
+# context packing: -c files and piped input are fitted into CONTEXT_BUDGET tokens before they're pasted into the
+# message. small files go in whole, whatever budget is left is shared evenly between the big ones, and a file over
+# its share is cut down to it: "truncate" keeps its start, "chunks" keeps evenly spaced CHUNK_TOKENS pieces of it
+# (labeled with their line numbers) so the whole file is represented. binary files are skipped, and big files are
+# only ever read as far as their share needs.
+# tokens are counted with tiktoken if it's installed, otherwise estimated at ~4 characters per token
+CONTEXT_BUDGET = 32000
+CHUNK_TOKENS = 500
+# past this size a file's token count is estimated from its size instead of reading all of it
+COUNT_MAX_BYTES = 1024 * 1024
+# generous upper bound on characters per token, for reading just enough of a file to fill a share
+MAX_CHARS_PER_TOKEN = 8
+
+_encoding = None
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except (ImportError, ValueError):
+            _encoding = False
+    return _encoding
+
+def tokenizer_name() -> str:
+    return get_encoding().name if get_encoding() else "chars/4"
+
+def count_tokens(text: str) -> int:
+    enc = get_encoding()
+    return len(enc.encode(text, disallowed_special=())) if enc else (len(text) + 3) // 4
+
+# the first `max_tokens` tokens of text, and whether anything was cut
+def cut_to_tokens(text: str, max_tokens: int) -> tuple[str, bool]:
+    enc = get_encoding()
+    if not enc:
+        return text[:max_tokens * 4], len(text) > max_tokens * 4
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text, False
+    return enc.decode(tokens[:max_tokens]), True
+
+def is_binary(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return b"\0" in f.read(8192)
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# per-file token counts in ~/.ask/token_counts.json, so running over the same tree again doesn't re-tokenize it.
+# an entry is reused while the file's mtime and size are unchanged, and if only the mtime moved (a checkout, a touch)
+# its sha256 is compared before tokenizing again
+class TokenCounts:
+    def __init__(self, path: str = None):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except json.JSONDecodeError:
+                pass
+
+    def count(self, path: str) -> int:
+        st = os.stat(path)
+        if st.st_size > COUNT_MAX_BYTES:
+            return st.st_size // 4
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry["tokenizer"] == tokenizer_name() and entry["size"] == st.st_size:
+            if entry["mtime"] == st.st_mtime:
+                return entry["tokens"]
+            sha256 = file_sha256(path)
+            if entry["sha256"] == sha256:
+                entry["mtime"] = st.st_mtime
+                self.dirty = True
+                return entry["tokens"]
+        else:
+            sha256 = file_sha256(path)
+        with open(path, 'r') as f:
+            tokens = count_tokens(f.read())
+        self.entries[key] = {"mtime": st.st_mtime, "size": st.st_size, "sha256": sha256, "tokens": tokens,
+                             "tokenizer": tokenizer_name()}
+        self.dirty = True
+        return tokens
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+
+def expand_globs(patterns: list[str]) -> list[str]:
+    paths = []
+    for file_pattern in patterns:
+        paths.extend(glob.glob(file_pattern))
+    return paths
+
+TRUNCATED = "\n[... truncated]"
+
+# the first `max_tokens` tokens of text, including the truncation marker if it had to be cut
+def fit_text(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    # too small a share to even say it was cut
+    if max_tokens <= count_tokens(TRUNCATED):
+        return cut_to_tokens(text, max_tokens)[0]
+    text, _ = cut_to_tokens(text, max_tokens - count_tokens(TRUNCATED))
+    return text + TRUNCATED
+
+# the start of a file, reading no more of it than `max_tokens` can need
+def read_head(path: str, max_tokens: int) -> str:
+    with open(path, 'r', errors='replace') as f:
+        text = f.read(max_tokens * MAX_CHARS_PER_TOKEN + 1)
+    return fit_text(text, max_tokens)
+
+# (first line, last line, byte offset, byte length) of each ~CHUNK_TOKENS piece of a file, one pass over it
+# without keeping any of its text
+def scan_chunks(path: str) -> list[tuple]:
+    chunk_bytes = CHUNK_TOKENS * 4
+    chunks = []
+    start, size, first_line, line_no = 0, 0, 1, 0
+    with open(path, 'rb') as f:
+        for line_no, line in enumerate(f, 1):
+            size += len(line)
+            if size >= chunk_bytes:
+                chunks.append((first_line, line_no, start, size))
+                start, size, first_line = start + size, 0, line_no + 1
+    if size:
+        chunks.append((first_line, line_no, start, size))
+    return chunks
+
+# evenly spaced pieces of a file, each labeled with its line numbers, adding up to at most `max_tokens` (labels and
+# the omitted note included). only the pieces that are kept are ever read into memory
+def read_chunks(path: str, max_tokens: int) -> str:
+    if max_tokens < CHUNK_TOKENS:
+        return read_head(path, max_tokens)
+    chunks = scan_chunks(path)
+    omitted = f"\n[... {len(chunks)} of {len(chunks)} chunks omitted]"
+    avail = max_tokens - count_tokens(omitted)
+    keep = min(len(chunks), max(1, avail // CHUNK_TOKENS))
+    # every piece after the first also costs the newline joining it on
+    per_piece = avail // keep - 1
+    # first to last chunk, so the end of the file is always in there
+    picks = [chunks[i * (len(chunks) - 1) // (keep - 1)] for i in range(keep)] if keep > 1 else chunks[:1]
+    pieces = []
+    with open(path, 'rb') as f:
+        for first_line, last_line, offset, size in picks:
+            f.seek(offset)
+            label = f"[lines {first_line}-{last_line}]\n"
+            # (a chunk can be one huge line, no need to read past what the piece can hold)
+            text = f.read(min(size, per_piece * MAX_CHARS_PER_TOKEN)).decode(errors='replace')
+            text, _ = cut_to_tokens(text, max(0, per_piece - count_tokens(label)))
+            pieces.append(label + text)
+    omitted = f"\n[... {len(chunks) - keep} of {len(chunks)} chunks omitted]" if keep < len(chunks) else ""
+    return "\n".join(pieces) + omitted
+
+# {name: text} for every context, fitted into `budget` tokens. `texts` are already in memory (piped input),
+# `paths` are files. `log` gets one line per context saying what happened to it
+def pack_contexts(paths: list[str], texts: dict = None, budget: int = CONTEXT_BUDGET, fit: str = "truncate",
+                  counts: TokenCounts = None, log=None) -> dict:
+    counts = counts or TokenCounts()
+    sizes = {}
+    for path in paths:
+        # a glob like src/* matches directories too
+        if not os.path.isfile(path):
+            log and log(f"{path}: not a file, skipped")
+            continue
+        try:
+            if is_binary(path):
+                log and log(f"{path}: binary, skipped")
+                continue
+            sizes[path] = counts.count(path)
+        except UnicodeDecodeError:
+            log and log(f"{path}: not utf-8 text, skipped")
+    for name, text in (texts or {}).items():
+        sizes[name] = count_tokens(text)
+    counts.save()
+
+    # water-filling: smallest first, each gets min(its size, an even split of what's left)
+    shares = {}
+    remaining = budget
+    by_size = sorted(sizes, key=sizes.get)
+    for i, name in enumerate(by_size):
+        shares[name] = min(sizes[name], remaining // (len(by_size) - i))
+        remaining -= shares[name]
+
+    contexts = {}
+    for name in sizes:
+        share = shares[name]
+        if name in (texts or {}):
+            contexts[name] = fit_text(texts[name], share)
+        elif share >= sizes[name]:
+            with open(name, 'r') as f:
+                contexts[name] = f.read()
+        elif fit == "chunks":
+            contexts[name] = read_chunks(name, share)
+        else:
+            contexts[name] = read_head(name, share)
+        if log:
+            log(f"{name}: {sizes[name]} tokens" + (f", cut to {share}" if share < sizes[name] else ""))
+    return contexts
+
+# piped input is read only as far as any budget could use, the rest is drained without being kept
+def read_stdin(budget: int) -> str:
+    text = sys.stdin.read(budget * MAX_CHARS_PER_TOKEN)
+    while sys.stdin.read(1 << 20):
+        pass
+    return text.strip()
+
+# caps requests in flight for batch mode, and backs off when the api says 429: the cap is halved and everyone
+# waits out the retry-after, then it creeps back up (by ~1 per `limit` successes) towards `max_concurrency`
+class AdaptiveLimiter:
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.cond = asyncio.Condition()
 
+    async def acquire(self):
+        async with self.cond:
+            while self.in_flight >= int(self.limit):
+                await self.cond.wait()
+            self.in_flight += 1
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self, rate_limited: bool = False, retry_after: float = 1.0):
+        async with self.cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(1.0, self.limit / 2)
+                self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+# one batch item -> one output record. the reply isn't printed, only returned in the record.
+# the item's context is packed once it holds a slot, so only the items in flight have theirs in memory
+async def run_batch_item(client, limiter: AdaptiveLimiter, item: dict, system_prompt: str, cache_dir: str,
+                         budget: int = CONTEXT_BUDGET, counts: TokenCounts = None, fit: str = "truncate") -> dict:
+    import openai
+    t_start = time.monotonic()
+    elapsed = lambda: round(time.monotonic() - t_start, 4)
+    record = {"id": item["id"], "prompt": item.get("prompt")}
+    if not isinstance(item.get("prompt"), str):
+        return record | {"error": "no \"prompt\" string in this line", "total": elapsed()}
+    await limiter.acquire()
+    try:
+        patterns = item.get("context") or []
+        contexts = pack_contexts(expand_globs([patterns] if isinstance(patterns, str) else patterns), budget=budget,
+                                 fit=fit, counts=counts)
+    except OSError as e:
+        await limiter.release()
+        return record | {"error": f"context: {e}", "total": elapsed()}
+    chat = [fmt_system_prompt(system_prompt), fmt_new_message(item["prompt"], contexts)]
+
+    key = cache_key(chat) if cache_dir else None
+    cached = cache_get(cache_dir, key) if cache_dir else None
+    if cached is not None:
+        await limiter.release()
+        return record | {"response": cached, "cached": True, "total": elapsed()}
+
+    retries = 0
+    while True:
+        t_sent = time.monotonic()
+        stats = {}
+        try:
+            response = await ask_openai(client, chat, stats, emit=lambda _: None)
+        except openai.RateLimitError as e:
+            retries += 1
+            retry_after = float(e.response.headers.get("retry-after") or 2 ** retries)
+            await limiter.release(rate_limited=True, retry_after=retry_after)
+            if retries > BATCH_MAX_RETRIES:
+                return record | {"error": "rate limited", "retries": retries, "total": elapsed()}
+            await limiter.acquire()
+            continue
+        # the client's own retries are off (they'd hide 429s from the limiter), so transient failures are retried
+        # here, with backoff but without slowing down the other items
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            retries += 1
+            await limiter.release()
+            if retries > BATCH_MAX_RETRIES:
+                return record | {"error": repr(e), "retries": retries, "total": elapsed()}
+            await asyncio.sleep(0.5 * 2 ** retries)
+            await limiter.acquire()
+            continue
+        except openai.OpenAIError as e:
+            await limiter.release()
+            return record | {"error": repr(e), "retries": retries, "total": elapsed()}
+        await limiter.release()
+        break
+    # ask_openai swallows a cancel (ctrl-c) and returns None: pass it on, there's no result to record
+    if response is None:
+        raise asyncio.CancelledError
+
+    if cache_dir:
+        cache_put(cache_dir, key, response)
+    # wait: time spent queued behind the limiter and 429 pauses, the rest is the request itself
+    return record | {"response": response, "retries": retries, "wait": round(t_sent - t_start, 4),
+                     "ttft": round(stats["ttft"], 4) if stats["ttft"] is not None else None,
+                     "tokens": stats["tokens"], "total": elapsed()}
+
+# --batch: every line of `lines` is {"prompt": str, "context": path / glob / list of them, "id": anything}
+# (context and id optional, id defaults to the line number). all of them run concurrently under the limiter and
+# each result is written to `out` as one json line the moment it finishes, so output is in completion order
+async def run_batch(lines, out, concurrency: int, system_prompt: str, cache_dir: str = None,
+                    budget: int = CONTEXT_BUDGET, counts: TokenCounts = None, fit: str = "truncate"):
+    client = make_client(max_retries=0)
+    limiter = AdaptiveLimiter(concurrency)
+    counts = counts or TokenCounts()
+    items = []
+    bad_lines = 0
+
+    def _write(record):
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+
+    # a line that isn't a json object is reported as that line's error instead of stopping the batch
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            item = f"bad json: {e}"
+        if not isinstance(item, dict):
+            _write({"id": n, "error": item if isinstance(item, str) else "not a json object"})
+            bad_lines += 1
+            continue
+        item.setdefault("id", n)
+        items.append(item)
+
+    async def _run(item):
+        try:
+            record = await run_batch_item(client, limiter, item, system_prompt, cache_dir, budget, counts, fit)
+        except Exception as e:
+            # anything unexpected fails this item only
+            record = {"id": item["id"], "prompt": item.get("prompt"), "error": repr(e)}
+        _write(record)
+        return "error" not in record
+
+    t_start = time.monotonic()
+    ok = await asyncio.gather(*[_run(item) for item in items])
+    counts.save()
+    print(f"[batch] {sum(ok)}/{len(items) + bad_lines} ok in {time.monotonic() - t_start:.1f}s", file=sys.stderr)
+
+# conversations are kept as append-only logs, one per named session (--session, default "default") in
+# ~/.ask/sessions/<name>.jsonl. every line is one message: {"role", "text", "context": {name: text}, "time"}, where
+# a "system" line starts a new conversation, and context is the packed context that went with a question.
+# saving a turn appends two lines, and --resume reads the log backwards from the end, only as far as the
+# conversation's start or the history window: the last HISTORY_TURNS exchanges that fit in HISTORY_TOKENS.
+# the newest exchange always goes in with its context, older ones drop their context first when it doesn't fit
+HISTORY_TURNS = 10
+HISTORY_TOKENS = 8000
+DEFAULT_SESSION = "default"
+# how much of a log is read at a time when walking it backwards
+TAIL_BLOCK = 64 * 1024
+
+def session_path(sessions_dir: str, name: str) -> str:
+    if not name or name != os.path.basename(name) or name.startswith("."):
+        raise ValueError(f"bad session name {name!r}")
+    return os.path.join(sessions_dir, name + ".jsonl")
+
+def log_record(role: str, text: str, contexts: dict = None) -> str:
+    record = {"role": role, "text": text, "time": round(time.time(), 3)}
+    if contexts:
+        record["context"] = contexts
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+# one write per turn, so a crash never leaves a question without its answer. if an earlier write was torn, its
+# partial line is ended first so it doesn't swallow the first record of this turn
+def append_turns(path: str, lines: list[str]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a+b') as f:
+        prefix = b""
+        if f.seek(0, os.SEEK_END):
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                prefix = b"\n"
+        f.write(prefix + "".join(lines).encode())
+
+# a line that isn't a whole record (a write torn by a crash or a full disk) is skipped rather than losing the session
+def parse_log_line(line: bytes) -> dict:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) and "role" in record and "text" in record else None
+
+# the log's records, newest first, read in TAIL_BLOCK blocks from the end of the file
+def iter_log_reversed(path: str):
+    with open(path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        rest = b""
+        while pos > 0:
+            step = min(TAIL_BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + rest).split(b"\n")
+            # the first line may continue in the previous block
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip() and (record := parse_log_line(line)) is not None:
+                    yield record
+        if rest.strip() and (record := parse_log_line(rest)) is not None:
+            yield record
+
+# with_context=False leaves a question's context out and just names it. (logs from before contexts were
+# saved only have the names)
+def fmt_logged_message(record: dict, with_context: bool = True) -> dict:
+    if record["role"] == "assistant":
+        return fmt_response(record["text"])
+    context = record.get("context")
+    if with_context and isinstance(context, dict):
+        return fmt_new_message(record["text"], context)
+    msg = record["text"]
+    if context:
+        msg += f"\n\n(context sent at the time: {', '.join(context)})"
+    return fmt_new_message(msg)
+
+def message_tokens(msg: dict) -> int:
+    return count_tokens(msg["content"][0]["text"])
+
+# the tail of the session's current conversation as chat messages, oldest first: whole exchanges, at most
+# `max_turns` of them and at most `max_tokens` (the newest exchange is always kept)
+def load_history(path: str, max_turns: int = HISTORY_TURNS, max_tokens: int = HISTORY_TOKENS) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    turns, pending, tokens = [], [], 0
+    for record in iter_log_reversed(path):
+        if record["role"] == "system" or len(turns) >= max_turns:
+            break
+        pending.insert(0, record)
+        # an exchange is complete once we've walked back to its question
+        if record["role"] == "user":
+            turn = [fmt_logged_message(r) for r in pending]
+            size = sum(message_tokens(msg) for msg in turn)
+            if turns and tokens + size > max_tokens and record.get("context"):
+                turn = [fmt_logged_message(r, with_context=False) for r in pending]
+                size = sum(message_tokens(msg) for msg in turn)
+            if turns and tokens + size > max_tokens:
+                break
+            tokens += size
+            turns.insert(0, turn)
+            pending = []
+    return [msg for turn in turns for msg in turn]
+
+# name, exchanges, last used, for --sessions
+def list_sessions(sessions_dir: str) -> list[tuple]:
+    if not os.path.isdir(sessions_dir):
+        return []
+    sessions = []
+    for file in sorted(os.listdir(sessions_dir)):
+        if file.endswith(".jsonl"):
+            path = os.path.join(sessions_dir, file)
+            with open(path, 'rb') as f:
+                turns = sum(b'"role": "user"' in line for line in f)
+            sessions.append((file[:-len(".jsonl")], turns, os.path.getmtime(path)))
+    return sessions
+
+# the single-conversation buffer.json from before sessions, moved into the default session once
+def migrate_buffer(buffer_filepath: str, sessions_dir: str):
+    path = session_path(sessions_dir, DEFAULT_SESSION)
+    if not os.path.exists(buffer_filepath) or os.path.exists(path):
+        return
+    with open(buffer_filepath, 'r') as f:
+        chat = json.load(f)
+    append_turns(path, [log_record(msg["role"], msg["content"][0]["text"]) for msg in chat])
+    os.replace(buffer_filepath, buffer_filepath + ".migrated")
+
+def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="ask an llm a question")
-    parser.add_argument('message', type=str, help='message')
+    parser.add_argument('message', type=str, nargs='?', help='message')
     parser.add_argument('-r', '--resume', action='store_true', help='resume conversation')
     parser.add_argument('-t', '--temp', action='store_true', help='dont store convo')
+    parser.add_argument('-S', '--session', type=str, default=DEFAULT_SESSION, help='named conversation to use')
+    parser.add_argument('--sessions', action='store_true', help='list saved sessions')
+    parser.add_argument('--history', type=int, default=HISTORY_TURNS, help='past exchanges sent with --resume')
     parser.add_argument('-v', '--verbose', action='store_true', help='be verbose')
     parser.add_argument('-c', '--context', nargs='+', help='list of context files')
-
+    parser.add_argument('-s', '--stats', action='store_true', help='print latency stats to stderr')
+    parser.add_argument('--daemon', action='store_true', help='stay running with a warm client for other invocations')
+    parser.add_argument('--cache', action='store_true', help='reuse replies to identical requests (also ASK_CACHE=1)')
+    parser.add_argument('-b', '--batch', type=str, help='run every prompt in this jsonl file (- for stdin)')
+    parser.add_argument('-o', '--output', type=str, help='batch results go here instead of stdout')
+    parser.add_argument('-j', '--concurrency', type=int, default=BATCH_CONCURRENCY, help='batch requests in flight')
+    parser.add_argument('--budget', type=int, default=CONTEXT_BUDGET, help='max tokens of context to send')
+    parser.add_argument('--fit', choices=["truncate", "chunks"], default="truncate",
+                        help='how a context file over its share of the budget is cut down')
     args = parser.parse_args()
+    if args.message is None and not args.daemon and not args.batch and not args.sessions:
+        parser.error("the following arguments are required: message")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    return args
+
+async def main():
 
+    SYSTEM_PROMPT = "You are a helpful assistant that provides concise replies to the user's query."
+
+    home_dir = os.environ['HOME']
+    BUFFER_FILEPATH = os.path.join(home_dir, ".ask", "buffer.json")
+    DAEMON_SOCKET = os.path.join(home_dir, ".ask", "daemon.sock")
+    CACHE_DIR = os.path.join(home_dir, ".ask", "cache")
+    TOKEN_COUNTS = os.path.join(home_dir, ".ask", "token_counts.json")
+    SESSIONS_DIR = os.path.join(home_dir, ".ask", "sessions")
+
+    # parse args before touching anything slow, so --help and typos are instant
+    args = parse_args()
+    if args.daemon:
+        return await serve_daemon(DAEMON_SOCKET)
+    migrate_buffer(BUFFER_FILEPATH, SESSIONS_DIR)
+    if args.sessions:
+        for name, turns, mtime in list_sessions(SESSIONS_DIR):
+            print(f"{name:<20} {turns:>5} exchanges   last used {time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))}")
+        return
+    try:
+        session_file = session_path(SESSIONS_DIR, args.session)
+    except ValueError as e:
+        return f"error: {e}"
+    if args.batch:
+        cache_dir = CACHE_DIR if args.cache or os.environ.get("ASK_CACHE") == "1" else None
+        if args.batch == "-":
+            lines = sys.stdin.readlines()
+        else:
+            with open(args.batch, 'r') as f:
+                lines = f.readlines()
+        out = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            return await run_batch(lines, out, args.concurrency, SYSTEM_PROMPT, cache_dir, args.budget,
+                                   TokenCounts(TOKEN_COUNTS), args.fit)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    chat = []
     # Handle wildcard pattern if provided
-    if args.context:
-        expanded_files = []
-        for file_pattern in args.context:
-            expanded_files.extend(glob.glob(file_pattern))
-        args.context = expanded_files
+    context_paths = expand_globs(args.context) if args.context else []
 
     # Print the arguments (or handle them as needed)
     if args.verbose:
         print(f"message: {args.message}")
         print(f"temp flag: {args.temp}")
         print(f"resume flag: {args.resume}")
-        print(f"context files: {args.context}")
-    
-    chat = []
-    contexts = {}
-    if args.context:
-        for context_file in args.context:
-            try:
-                with open(context_file, 'r') as f:
-                    contexts[context_file] = f.read()
-            except FileNotFoundError:
-                return f"error: context file {context_file} not found..."
+        print(f"session: {args.session}")
+        print(f"context files: {context_paths}")
 
 
     # check for piped input
-    if not sys.stdin.isatty():
-        piped_input = sys.stdin.read().strip()
-        contexts["stdin"] = piped_input
+    piped = {}
+    if not sys.stdin.isatty() and (piped_input := read_stdin(args.budget)):
+        piped["stdin"] = piped_input
         if args.verbose:
-            print(f"piped input: {piped_input}")
+            print(f"piped input: {piped['stdin']}")
 
-    # if we're resuming, load the convo
+    try:
+        contexts = pack_contexts(context_paths, piped, args.budget, args.fit, TokenCounts(TOKEN_COUNTS),
+                                 log=print if args.verbose else None)
+    except OSError as e:
+        return f"error: couldn't read context file {e.filename}..."
+
+    # if we're resuming, load the tail of the convo
+    chat.append(fmt_system_prompt(SYSTEM_PROMPT))
     if args.resume:
-        chat = load_convo(BUFFER_FILEPATH)
-    else:
-        chat.append(fmt_system_prompt(SYSTEM_PROMPT))
-    
+        chat.extend(load_history(session_file, args.history))
+
     # add the new message to the chat, with relevant contexts
     chat.append(fmt_new_message(args.message, contexts))
 
@@ -151,17 +828,45 @@ async def main():
         print(chat)
 
     # ask the llm the question, add the response to current chat
-    chat.append(fmt_response(await ask_openai(client, chat)))
+    stats = {} if args.stats else None
+    response = None
+    use_cache = args.cache or os.environ.get("ASK_CACHE") == "1"
+    cached = None
+    if use_cache:
+        key = cache_key(chat)
+        cached = cache_get(CACHE_DIR, key)
+    if cached is not None:
+        response = replay_response(cached, stats)
+    else:
+        if os.path.exists(DAEMON_SOCKET):
+            try:
+                response = await ask_daemon(DAEMON_SOCKET, chat, stats)
+            except (ConnectionError, FileNotFoundError) as e:
+                # stale socket from a daemon that's gone, or the daemon failed before replying: ask directly
+                if args.verbose:
+                    print(f"daemon unavailable ({e}), sending the request directly", file=sys.stderr)
+        if response is None:
+            response = await ask_openai(make_client(), chat, stats)
+        if use_cache and response is not None:
+            cache_put(CACHE_DIR, key, response)
+    chat.append(fmt_response(response))
+    if stats:
+        print("\n" + fmt_stats(stats), file=sys.stderr)
 
-    # if user asked, save the chat to the buffer
-    if not args.temp:
-        save_convo(BUFFER_FILEPATH, chat)
+    # if user asked, append the exchange to the session's log
+    if not args.temp and response is not None:
+        turn = [log_record("user", args.message, contexts), log_record("assistant", response)]
+        if not args.resume:
+            turn.insert(0, log_record("system", SYSTEM_PROMPT))
+        append_turns(session_file, turn)
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        err = asyncio.run(main())
+        if err:
+            sys.exit(err)
     except KeyboardInterrupt:
-        print("<CTRL-C> exiting...")
+        print("<CTRL-C> exiting...", file=sys.stderr)
 
 
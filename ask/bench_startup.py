@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+
+# tracks how long `ask` takes before it does anything useful, so heavy imports don't creep back into the cold path.
+# each case is a fresh interpreter, timed end to end (median of --runs), plus python -X importtime's view of
+# ask.py's own import and the slowest modules it pulls in. no network involved.
+#
+#   python bench_startup.py
+#   python bench_startup.py --runs 20 --out startup.json
+
+ASK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ask.py")
+
+CASES = {
+    "interpreter": [sys.executable, "-c", "pass"],
+    "ask --help": [sys.executable, ASK, "--help"],
+    "ask (arg error)": [sys.executable, ASK],
+    "import ask": [sys.executable, "-c", f"import sys; sys.path.insert(0, {os.path.dirname(ASK)!r}); import ask"],
+    # what a request pays on top, for reference
+    "import openai": [sys.executable, "-c", "import openai"],
+}
+
+def time_case(cmd: list[str], runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        t_start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t_start)
+    return statistics.median(times)
+
+# (module, cumulative us) for the slowest top-level imports under `cmd`
+def slowest_imports(cmd: list[str], top: int = 5) -> list:
+    proc = subprocess.run([cmd[0], "-X", "importtime"] + cmd[1:], capture_output=True, text=True)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # only top-level imports (no leading indentation)
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports.append((name.strip(), int(cumulative)))
+    return sorted(imports, key=lambda x: -x[1])[:top]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="startup time benchmarks for ask")
+    parser.add_argument('--runs', type=int, default=10, help='runs per case (the median is reported)')
+    parser.add_argument('--out', type=str, default=None, help='also write the results to this json file')
+    args = parser.parse_args()
+
+    results = {}
+    for name, cmd in CASES.items():
+        results[name] = round(time_case(cmd, args.runs) * 1000, 1)
+        print(f"{name:<20} {results[name]:>8.1f} ms")
+    imports = slowest_imports(CASES["ask --help"])
+    print("slowest imports on the --help path: " + ", ".join(f"{name} {us / 1000:.1f}ms" for name, us in imports))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"time": time.time(), "runs": args.runs, "median_ms": results,
+                       "slowest_imports_us": imports}, f, indent=2)
+        print(f"wrote results to {args.out}")
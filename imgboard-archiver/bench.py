@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import contextlib
+import multiprocessing
+
+import main
+import store
+from fake_api import FakeBoard, FakeApiServer
+
+# end-to-end benchmarks against fake_api.py, so changes to Api / find_matching / download_from_threads / the store
+# can be measured offline and tracked over time. every scenario runs in its own process (peak RSS is per scenario)
+# with a fresh scratch dir + db, talking to one fake server in this process.
+#
+#   python bench.py                                   # everything with the defaults
+#   python bench.py scan download --latency=0.05      # pick scenarios, simulate a slow link
+#   python bench.py cache --cache-sizes 10 1000 10000 --out=bench.json
+
+
+# archive scan with no matches: one archive.json + one thread fetch per entry
+def scenario_scan(api: main.Api, fake: FakeBoard, args) -> dict:
+    main.find_matching(fake.board, "nothing matches this", api, _tries=args.threads)
+    return {"threads": args.threads}
+
+
+# full-size downloads of every image in the matching threads through the worker pool
+def scenario_download(api: main.Api, fake: FakeBoard, args) -> dict:
+    threads = [posts for posts in fake.threads.values()]
+    main.download_from_threads(api, fake.board, threads, args.workers)
+    return {"images": fake.num_images(), "workers": args.workers,
+            "downloaded": api.metrics.counters.get("img_downloaded", 0)}
+
+
+# store costs with `size` threads already sitting in the cache: caching, the seen-index load, and purging them all
+def scenario_cache(api: main.Api, fake: FakeBoard, args, size: int) -> dict:
+    thread = next(iter(fake.threads.values()))
+    t_start = time.monotonic()
+    for i in range(size):
+        store.cache_thread([dict(thread[0], no=i)] + thread[1:])
+    t_cached = time.monotonic()
+    known = store.get_known_threadnos()
+    t_loaded = time.monotonic()
+    for i in range(size):
+        store.mark_thread_as_seen(i)
+    t_purged = time.monotonic()
+    return {"cache_size": size, "known": len(known),
+            "cache_s": round(t_cached - t_start, 4), "load_known_s": round(t_loaded - t_cached, 4),
+            "purge_s": round(t_purged - t_loaded, 4)}
+
+
+def _run(name, url, fake, args, extra, results):
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+        os.chdir(tmp)
+        store.use_db(os.path.join(tmp, "archive.db"))
+        main.JSON_URL = main.IMG_URL = url
+        api = main.Api(outdir=os.path.join(tmp, "out"), ratelimit=args.ratelimit, workers=args.workers)
+        api.loglvl = main.SILENT
+        t_start = time.monotonic()
+        with contextlib.redirect_stdout(devnull):
+            if name == "cache":
+                res = scenario_cache(api, fake, args, extra)
+            else:
+                res = SCENARIOS[name](api, fake, args)
+        res["wall_s"] = round(time.monotonic() - t_start, 4)
+        res["bytes"] = api.metrics.bytes_downloaded
+        res["limiter_sleep_s"] = round(api.metrics.limiter_sleep, 3)
+        # linux reports KB
+        res["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        results.put(res)
+
+
+def run_scenario(name: str, server: FakeApiServer, args, extra=None) -> dict:
+    requests_before = server.num_requests
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run, args=(name, server.url, server.fake_board, args, extra, results))
+    proc.start()
+    res = results.get()
+    proc.join()
+    res["requests"] = server.num_requests - requests_before
+    res["req_per_s"] = round(res["requests"] / res["wall_s"], 1) if res["wall_s"] else 0
+    return {"scenario": name} | res
+
+
+SCENARIOS = {"scan": scenario_scan, "download": scenario_download, "cache": scenario_cache}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline benchmarks for the archiver against a fake 4chan api")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f'any of {list(SCENARIOS)}')
+    parser.add_argument('--threads', type=int, default=200, help='threads in the fake archive')
+    parser.add_argument('--posts', type=int, default=50, help='posts per thread')
+    parser.add_argument('--img-ratio', type=float, default=0.3, help='fraction of posts with an image')
+    parser.add_argument('--img-kb', type=int, nargs=2, default=[20, 200], help='min/max image size in KB')
+    parser.add_argument('--dup-ratio', type=float, default=0.0, help='fraction of images that are reposts')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake server waits per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that get a 503')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--ratelimit', type=float, default=0, help='seconds between requests (0 = off)')
+    parser.add_argument('--cache-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--out', type=str, default=None, help='also write the results to this json file')
+    args = parser.parse_args()
+
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        sys.exit(f"unknown scenarios: {unknown}")
+
+    fake = FakeBoard(num_threads=args.threads, posts_per_thread=args.posts, img_ratio=args.img_ratio,
+                     img_size=(args.img_kb[0] * 1024, args.img_kb[1] * 1024), dup_ratio=args.dup_ratio)
+    server = FakeApiServer(fake, latency=args.latency, error_rate=args.error_rate).start()
+    print(f"fake api on {server.url}: {args.threads} threads, {fake.num_images()} images, "
+          f"latency {args.latency}s, error rate {args.error_rate}")
+
+    all_results = []
+    try:
+        for name in args.scenarios:
+            for extra in (args.cache_sizes if name == "cache" else [None]):
+                res = run_scenario(name, server, args, extra)
+                all_results.append(res)
+                print(json.dumps(res))
+    finally:
+        server.stop()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"args": vars(args), "time": time.time(), "results": all_results}, f, indent=2)
+        print(f"wrote results to {args.out}")
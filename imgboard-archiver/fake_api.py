@@ -0,0 +1,184 @@
+import json
+import time
+import random
+import base64
+import hashlib
+import threading
+import argparse
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a local stand-in for a.4cdn.org + i.4cdn.org so Api / find_matching / download_from_threads can be measured
+# without hitting 4chan or its rate limits. serves one board made of synthetic threads:
+#   /{board}/archive.json, /{board}/thread/{no}.json, /{board}/threads.json, /{board}/catalog.json,
+#   /{board}/{tim}{ext} and /{board}/{tim}s.jpg (synthetic bytes, with the right fsize and md5 in the thread json)
+# supports If-Modified-Since (304s) and Range (206s) like the real thing, and can add latency and random 503s.
+#
+# point main.py at it with:  main.JSON_URL = main.IMG_URL = server.url
+
+
+# deterministic filler bytes for an image, cheap enough to regenerate on every request
+def img_bytes(tim: int, size: int) -> bytes:
+    seed = tim.to_bytes(8, "little")
+    return (seed * (size // 8 + 1))[:size]
+
+
+class FakeBoard:
+    def __init__(self, board="g", num_threads=100, posts_per_thread=50, img_ratio=0.5, img_size=(20_000, 200_000),
+                 match_ratio=0.1, match_title="/sdg/ - Stable Diffusion General", dup_ratio=0.0, seed=0):
+        self.board = board
+        rng = random.Random(seed)
+        self.threads = {}
+        tim = 1684559317608662
+        first_no = 93545157
+        seen_imgs = []
+        for i in range(num_threads):
+            op_no = first_no + i * (posts_per_thread + 1)
+            title = match_title if rng.random() < match_ratio else f"random thread {i}"
+            posts = []
+            for j in range(posts_per_thread):
+                post = {"no": op_no + j, "now": "05/20/23(Sat)01:07:47", "name": "Anonymous", "resto": 0 if j == 0
+                        else op_no, "time": 1684559317 + j}
+                if j == 0:
+                    post["sub"] = title
+                if j == 0 or rng.random() < img_ratio:
+                    if seen_imgs and rng.random() < dup_ratio:
+                        # a repost: same bytes (same md5) under a new tim
+                        src = rng.choice(seen_imgs)
+                        size, src_tim = src["fsize"], src["_src_tim"]
+                    else:
+                        size, src_tim = rng.randint(*img_size), tim
+                    tim += 1
+                    data = img_bytes(src_tim, size)
+                    post.update({"filename": f"{rng.randint(0, 99999):05d}-{rng.randint(0, 2**32)}", "ext": ".png",
+                                 "w": rng.choice([512, 768, 1024, 1216]), "h": rng.choice([512, 768, 1024, 2000]),
+                                 "tn_w": 125, "tn_h": 125, "tim": tim, "fsize": size, "_src_tim": src_tim,
+                                 "md5": base64.b64encode(hashlib.md5(data).digest()).decode()})
+                    seen_imgs.append(post)
+                posts.append(post)
+            self.threads[op_no] = posts
+
+        # tim -> (source tim, size) so image requests don't need to search the threads
+        self.imgs = {post["tim"]: (post["_src_tim"], post["fsize"])
+                     for posts in self.threads.values() for post in posts if "tim" in post}
+        for posts in self.threads.values():
+            for post in posts:
+                post.pop("_src_tim", None)
+        self.archive = json.dumps(sorted(self.threads)).encode()
+        self.thread_json = {no: json.dumps({"posts": posts}).encode() for no, posts in self.threads.items()}
+        ops = [posts[0] | {"replies": len(posts) - 1, "last_modified": 1684559317} for posts in self.threads.values()]
+        self.catalog = json.dumps([{"page": 1, "threads": ops}]).encode()
+        self.threads_index = json.dumps([{"page": 1, "threads": [{"no": op["no"], "last_modified": 1684559317,
+                                                                   "replies": op["replies"]} for op in ops]}]).encode()
+
+    def num_images(self) -> int:
+        return len(self.imgs)
+
+
+class FakeApiServer:
+    def __init__(self, fake_board: FakeBoard, latency=0.0, error_rate=0.0, host="127.0.0.1", port=0, seed=0):
+        self.fake_board = fake_board
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.bytes_sent = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+    def start(self) -> "FakeApiServer":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # keep-alive + separate header/body writes otherwise hit the 40ms delayed-ACK stall on every request
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes = b"", headers: dict = None):
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.bytes_sent += len(body)
+
+            def _send_json(self, body: bytes):
+                if self.headers.get("If-Modified-Since") == server.last_modified:
+                    return self._send(304)
+                self._send(200, body, {"Content-Type": "application/json", "Last-Modified": server.last_modified})
+
+            def _send_img(self, data: bytes):
+                rng = self.headers.get("Range")
+                if rng and rng.startswith("bytes="):
+                    start = int(rng[len("bytes="):].split("-")[0] or 0)
+                    if start >= len(data):
+                        return self._send(416)
+                    content_range = f"bytes {start}-{len(data) - 1}/{len(data)}"
+                    return self._send(206, data[start:], {"Content-Range": content_range})
+                self._send(200, data)
+
+            def do_GET(self):
+                with server.lock:
+                    server.num_requests += 1
+                    fail = server.rng.random() < server.error_rate
+                if server.latency:
+                    time.sleep(server.latency)
+                if fail:
+                    return self._send(503)
+
+                fb = server.fake_board
+                parts = self.path.strip("/").split("/")
+                if not parts or parts[0] != fb.board:
+                    return self._send(404)
+                rest = parts[1:]
+                if rest == ["archive.json"]:
+                    return self._send_json(fb.archive)
+                if rest == ["catalog.json"]:
+                    return self._send_json(fb.catalog)
+                if rest == ["threads.json"]:
+                    return self._send_json(fb.threads_index)
+                if len(rest) == 2 and rest[0] == "thread" and rest[1].endswith(".json"):
+                    body = fb.thread_json.get(int(rest[1][:-len(".json")]))
+                    return self._send_json(body) if body is not None else self._send(404)
+                if len(rest) == 1:
+                    name = rest[0].split(".")[0]
+                    thumb = name.endswith("s")
+                    img = fb.imgs.get(int(name[:-1] if thumb else name))
+                    if img is None:
+                        return self._send(404)
+                    src_tim, size = img
+                    return self._send_img(img_bytes(src_tim, 2000 if thumb else size))
+                self._send(404)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve a fake 4chan api locally")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--threads', type=int, default=100, help='threads in the archive')
+    parser.add_argument('--posts', type=int, default=50, help='posts per thread')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+    args = parser.parse_args()
+
+    fake = FakeApiServer(FakeBoard(num_threads=args.threads, posts_per_thread=args.posts), latency=args.latency,
+                         error_rate=args.error_rate, port=args.port)
+    print(f"serving /g/ with {args.threads} threads, {fake.fake_board.num_images()} images on {fake.url}")
+    fake.httpd.serve_forever()
@@ -0,0 +1,70 @@
+import re
+import importlib
+from collections.abc import Callable
+
+# image filtering happens in two stages, both before any full-size download:
+#  1. predicates over the post metadata the api already gave us (dimensions, ext, fsize, filename). free.
+#  2. optionally, a classifier that gets the posts' thumbnails ({tim}s.jpg, a few KB each) in batches.
+# only posts that pass both get downloaded.
+#
+# a predicate is any `(post: dict) -> bool`, a classifier is `(posts: list[dict], thumbs: list[bytes]) -> list[bool]`
+
+Predicate = Callable[[dict], bool]
+Classifier = Callable[[list[dict], list[bytes]], list[bool]]
+
+
+def min_size(w: int = 0, h: int = 0) -> Predicate:
+    return lambda post: post.get("w", 0) >= w and post.get("h", 0) >= h
+
+
+def ext_in(*exts: str) -> Predicate:
+    exts = {ext.lower() if ext.startswith('.') else '.' + ext.lower() for ext in exts}
+    return lambda post: (post.get("ext") or "").lower() in exts
+
+
+def fsize_between(lo: int = 0, hi: int = None) -> Predicate:
+    return lambda post: post.get("fsize", 0) >= lo and (hi is None or post.get("fsize", 0) <= hi)
+
+
+def filename_matches(pattern: str) -> Predicate:
+    regex = re.compile(pattern)
+    return lambda post: regex.search(post.get("filename") or "") is not None
+
+
+# "some.module:function" -> the function, for passing a classifier on the command line
+def load_classifier(spec: str) -> Classifier:
+    module_name, _, func_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+class ImgFilter:
+    def __init__(self, predicates: list[Predicate] = None, classifier: Classifier = None, batch_size: int = 16):
+        self.predicates = list(predicates or [])
+        self.classifier = classifier
+        self.batch_size = batch_size
+
+    # chainable: ImgFilter().add(min_size(512, 512)).add(ext_in("png", "jpg"))
+    def add(self, predicate: Predicate) -> "ImgFilter":
+        self.predicates.append(predicate)
+        return self
+
+    def accepts(self, post: dict) -> bool:
+        return all(predicate(post) for predicate in self.predicates)
+
+    # runs both stages. fetch_thumb is `(post) -> bytes | None`, map_fn lets the caller fetch a batch concurrently
+    # (e.g. ThreadPoolExecutor.map). posts whose thumbnail couldn't be fetched are kept rather than silently lost
+    def select(self, posts: list[dict], fetch_thumb: Callable = None, map_fn: Callable = map) -> list[dict]:
+        posts = [post for post in posts if self.accepts(post)]
+        if self.classifier is None or fetch_thumb is None:
+            return posts
+
+        selected = []
+        for i in range(0, len(posts), self.batch_size):
+            batch = posts[i:i + self.batch_size]
+            thumbs = list(map_fn(fetch_thumb, batch))
+            fetched = [(post, thumb) for post, thumb in zip(batch, thumbs) if thumb is not None]
+            verdicts = self.classifier([post for post, _ in fetched], [thumb for _, thumb in fetched]) \
+                if fetched else []
+            rejected = {id(post) for (post, _), ok in zip(fetched, verdicts) if not ok}
+            selected.extend(post for post in batch if id(post) not in rejected)
+        return selected
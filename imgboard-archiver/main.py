@@ -1,9 +1,25 @@
 import requests
 import json
+import re
+import base64
+import hashlib
 import time
-import urllib.request
 import os
+import shutil
 import argparse
+import atexit
+import threading
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import Metrics
+from filters import ImgFilter, min_size, ext_in, fsize_between, filename_matches, load_classifier
+from store import get_watched, update_watched, drop_watched, get_img_path, add_img
+from store import get_http_cache, put_http_cache, get_known_threadnos, cache_thread, cache_threads, mark_thread_as_seen, pop_thread_cache
+from store import pop_cached_jobs
 
 # 4chan api
 JSON_URL = "http://a.4cdn.org"
@@ -14,11 +30,50 @@ DEBUG = 2
 NORMAL = 1
 SILENT = 0
 
+# connection errors and 429/5xx get retried with exponential backoff (1s, 2s, 4s), Retry-After is respected
+RETRIES = 3
+BACKOFF = 1
+TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+# --watch polling. 4chan asks for at least 10s between updates, idle threads/boards back off up to the max
+WATCH_MIN_INTERVAL = 10
+WATCH_MAX_INTERVAL = 300
+
+# thumbnail fetches for --classifier get their own few threads, so they don't queue behind the full-size downloads
+THUMB_WORKERS = 4
+
+
+# classic token bucket, shared by every request the Api makes so the whole pool respects the rate limit.
+# capacity=1 means no bursting: at most one request starts per 1/rate seconds no matter how many workers there are
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_t = time.monotonic()
+        self.lock = threading.Lock()
+
+    # blocks until a token is available, returns how long we slept
+    def acquire(self) -> float:
+        slept = 0.0
+        while True:
+            with self.lock:
+                t_now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (t_now - self.last_t) * self.rate)
+                self.last_t = t_now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return slept
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+            slept += wait_time
+
 
 # the functions that actually make requests go in this class
 # .. so we can optionally track state and respect the rate-limiter
 class Api:
-    def __init__(self, outdir, ratelimit=None):
+    def __init__(self, outdir, ratelimit=None, workers=1):
         self.loglvl = NORMAL
 
         self.img_path = outdir
@@ -30,54 +85,178 @@ class Api:
             self.ratelimit = 1
         else:
             self.ratelimit = ratelimit
-        self.last_request_t = time.time() - self.ratelimit
+        # ratelimit is seconds between requests (4chan asks for no more than 1/s), 0 disables it
+        self.limiter = TokenBucket(1 / self.ratelimit) if self.ratelimit else None
         self.num_requests = 0
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+
+        # one keep-alive session for everything, pool is big enough for every download worker to hold a connection
+        self.session = requests.Session()
+        retry = Retry(total=RETRIES, backoff_factor=BACKOFF, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(1, workers) + THUMB_WORKERS, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
     
     def log(self, msg, lvl: int):
         if lvl <= self.loglvl:
             print(msg)
 
-    def img_url_to_path(self, url):
-        return os.path.join(self.img_path, url.split('/')[-1])
+    def img_url_to_path(self, url, outdir=None):
+        return os.path.join(outdir if outdir is not None else self.img_path, url.split('/')[-1])
 
-    def download_img(self, url):
-        path = self.img_url_to_path(url)
+    # streams into <path>.part and only renames it to <path> once it's complete, so a file at the final path is
+    # always a finished one. an interrupted .part is picked up again with a Range request on the next attempt.
+    # when we have the post, the size and md5 from the api are checked before the rename
+    def download_img(self, url, prefix="", post=None, outdir=None) -> bool:
+        path = self.img_url_to_path(url, outdir)
+        part_path = path + ".part"
         if url.split('.')[-1] == "webm":
-            self.log(f"skipping .webm file...", NORMAL)
+            self.log(f"{prefix}skipping .webm file...", NORMAL)
+
+        md5 = hashlib.md5()
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            self.metrics.inc("img_resumed")
+        t_start = time.monotonic()
         try:
-            local_file_path, headers = urllib.request.urlretrieve(url, path)
-            self.log(f"Successfully downloaded {url} to {local_file_path}", NORMAL)
-            # You can also log headers info if needed.
-        except IOError:
-            self.log(f"Failed to download {url}", NORMAL)
-
-    def queue_download(self, url: str):
-        self.num_requests += 1
-        t_now = time.time()
-        if not self.ratelimit:
-            return self.download_img(url)
-
-        if t_now - self.last_request_t > self.ratelimit:
-            self.last_request_t = t_now
-            return self.download_img(url)
-        else:
-            wait_time = self.ratelimit - (t_now - self.last_request_t)
-            time.sleep(wait_time)
-            return self.download_img(url)
+            if offset:
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        md5.update(chunk)
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            with self.session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                # 416 means the .part already has every byte, it just never got renamed
+                if response.status_code != 416:
+                    response.raise_for_status()
+                    if offset and response.status_code != 206:
+                        self.log(f"{prefix}server ignored the range request, restarting {url}", NORMAL)
+                        offset = 0
+                        md5 = hashlib.md5()
+                    with open(part_path, 'ab' if offset else 'wb') as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                            md5.update(chunk)
+                            self.metrics.add_bytes(len(chunk))
+        except (requests.RequestException, IOError):
+            self.log(f"{prefix}Failed to download {url}, will resume next time", NORMAL)
+            self.metrics.inc("img_failed")
+            return False
+        finally:
+            self.metrics.observe("img", time.monotonic() - t_start)
+
+        if post is not None:
+            size = os.path.getsize(part_path)
+            fsize = post.get("fsize")
+            if fsize is not None and size < fsize:
+                self.log(f"{prefix}{url} is incomplete ({size}/{fsize} bytes), will resume next time", NORMAL)
+                self.metrics.inc("img_failed")
+                return False
+            if (fsize is not None and size > fsize) or \
+                    (post.get("md5") and base64.b64encode(md5.digest()).decode() != post.get("md5")):
+                self.log(f"{prefix}{url} doesn't match the size/md5 from the api, discarding it", NORMAL)
+                os.remove(part_path)
+                self.metrics.inc("img_corrupt")
+                return False
+
+        os.replace(part_path, path)
+        self.log(f"{prefix}Successfully downloaded {url} to {path}", NORMAL)
+        self.metrics.inc("img_downloaded")
+        return True
+
+    # safe to call from several worker threads at once, they all share self.limiter
+    def queue_download(self, url: str, prefix="", post=None, outdir=None) -> bool:
+        with self.lock:
+            self.num_requests += 1
+        if self.limiter is not None:
+            self.metrics.add_sleep(self.limiter.acquire())
+        return self.download_img(url, prefix, post, outdir)
+
+    # returns the parsed json, or None on any error.
+    # conditional=True keeps the body + ETag/Last-Modified in the local db and sends them back next time,
+    # so an unchanged endpoint costs a 304 with no body (the 4chan api supports If-Modified-Since for this).
+    # only meant for small, frequently polled endpoints, don't use it for every thread
+    def get_json(self, url: str, conditional=False):
+        with self.lock:
+            self.num_requests += 1
+        # archive/thread/catalog fetches run alongside the downloads, so they take from the same bucket
+        if self.limiter is not None:
+            self.metrics.add_sleep(self.limiter.acquire())
+        cached = get_http_cache(url) if conditional else None
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        t_start = time.monotonic()
+        try:
+            response = self.session.get(url, headers=headers, timeout=TIMEOUT)
+        except requests.RequestException as e:
+            self.log(f"request to {url} failed: {e}", NORMAL)
+            self.metrics.inc("http_errors")
+            return None
+        finally:
+            self.metrics.observe("json", time.monotonic() - t_start)
+        self.metrics.add_bytes(len(response.content))
+
+        if response.status_code == 304 and cached is not None:
+            self.log(f"{url} not modified, using cached copy", DEBUG)
+            self.metrics.inc("http_not_modified")
+            return json.loads(cached[2])
+        if response.status_code != 200:
+            self.metrics.inc("http_errors")
+            return None
+
+        if conditional:
+            put_http_cache(url, response.headers.get("ETag"), response.headers.get("Last-Modified"), response.text)
+        try:
+            return response.json()
+        except ValueError:
+            return None
 
     def get_archive_threadnos(self, board: str) -> list[int]:
-        res = requests.get(JSON_URL + f"/{board}/archive.json").json()
+        res = self.get_json(JSON_URL + f"/{board}/archive.json", conditional=True)
         self.log(res, DEBUG)
-        return res
+        return res if res is not None else []
+
+    # small jpg thumbnail for a post, for ImgFilter classifiers. None if it couldn't be fetched
+    def get_thumbnail(self, board: str, post: dict):
+        with self.lock:
+            self.num_requests += 1
+        if self.limiter is not None:
+            self.metrics.add_sleep(self.limiter.acquire())
+        t_start = time.monotonic()
+        try:
+            response = self.session.get(get_thumbnail_url(board, post), timeout=TIMEOUT)
+        except requests.RequestException:
+            return None
+        finally:
+            self.metrics.observe("thumb", time.monotonic() - t_start)
+        self.metrics.add_bytes(len(response.content))
+        return response.content if response.status_code == 200 else None
 
     def get_thread(self, board: str, thread_no: int) -> list[dict]:
-        response = requests.get(JSON_URL + f"/{board}/thread/{thread_no}.json")
-        if response.status_code == 200:
-            res = response.json().get("posts")
-            self.log(res, DEBUG)
-            return res if res is not None else [{}]
-        else:
-            return [{}]
+        res = self.get_json(JSON_URL + f"/{board}/thread/{thread_no}.json")
+        res = res.get("posts") if isinstance(res, dict) else None
+        self.log(res, DEBUG)
+        return res if res else [{}]
+
+    # {thread_no: last_modified} for every live thread on the board, or None if the request failed.
+    # threads.json is tiny compared to the catalog and comes back 304 when nothing on the board changed
+    def get_live_threads(self, board: str):
+        res = self.get_json(JSON_URL + f"/{board}/threads.json", conditional=True)
+        if res is None:
+            return None
+        return {t.get("no"): t.get("last_modified", 0) for page in res for t in page.get("threads", [])}
+
+    # opening posts of every live thread, enough to match thread titles without fetching the threads
+    def get_catalog(self, board: str) -> list[dict]:
+        res = self.get_json(JSON_URL + f"/{board}/catalog.json", conditional=True)
+        return [t for page in res or [] for t in page.get("threads", [])]
 
 
 # mostly-pure functions to manipulate, filter, etc on threads once in memory are below
@@ -91,6 +270,10 @@ def get_img_url(board: str, post: dict) -> str:
     return IMG_URL + f'/{board}' + f'/{post.get("tim")}' + post.get("ext")
 
 
+def get_thumbnail_url(board: str, post: dict) -> str:
+    return IMG_URL + f'/{board}' + f'/{post.get("tim")}s.jpg'
+
+
 def has_img(post: dict) -> bool:
     return post.get("filename") is not None
 
@@ -104,161 +287,347 @@ def get_thread_no(thread: list[dict]) -> int:
     return thread[0].get("no")
 
 
-def get_img_urls_from_thread(board: str, thread: list[dict]) -> list[str]:
-    return list(map(lambda post: get_img_url(board, post), filter(include_img, filter(has_img, thread))))
-
+def get_img_posts_from_thread(thread: list[dict]) -> list[dict]:
+    return list(filter(include_img, filter(has_img, thread)))
 
-def get_seen_threadnos() -> list[int]:
-    with open('thread_cache.json', 'r') as json_file:
-        try:
-            data = json.load(json_file)
-        except json.JSONDecodeError:
-            data = []
 
-    return [thread[0].get("no") for thread in data if thread and thread[0]]
-
-
-# adds a thread to thread_cache if it's not there already.
-# returns true if a new unique thread was cached
-def cache_thread(thread: list[dict]) -> bool:
-    # Check if thread_cache.json exists, if not, create one.
-    if not os.path.isfile('thread_cache.json'):
-        with open('thread_cache.json', 'w') as f:
-            json.dump([], f)
-
-    threadnos = get_seen_threadnos()
-    if get_thread_no(thread) in threadnos:
-        return False
-
-    with open('thread_cache.json', 'r') as json_file:
-        try:
-            data = json.load(json_file)
-        except json.JSONDecodeError:
-            data = []
-
-    # Append new threads to existing data
-    data.append(thread)
-
-    # Write back to the file
-    with open('thread_cache.json', 'w') as json_file:
-        json.dump(data, json_file)
-
-    return True
-
-
-# returns the number of new threads that were cached
-def cache_threads(threads: list[list[dict]]) -> (int, int):
-    s = 0
-    for thread in threads:
-        s += 1 if cache_thread(thread) else 0
-    return s
+def get_img_urls_from_thread(board: str, thread: list[dict]) -> list[str]:
+    return [get_img_url(board, post) for post in get_img_posts_from_thread(thread)]
 
 
-def find_matching(_board: str, _pattern: str, api: Api, _tries=None, _count=None) -> list[list[dict]]:
+# yields matching threads as soon as they're found, so the caller can start downloading the first match
+# while the rest of the archive is still being scanned
+def iter_matching(_board: str, _pattern: str, api: Api, _tries=None, _count=None) -> Iterator[list[dict]]:
     print(f"looking for threads in {_board} with title containing {_pattern}")
     try_str = "" if _tries is None else f"will try {_tries} archive entries..."
     count_str = "" if _count is None else f"will stop when found {_count} matching threads..."
     print(try_str)
     print(count_str)
     print("="*20)
-    sdg_threads = []
+    found = 0
     archive = api.get_archive_threadnos(_board)
     if _tries is None:
         _tries = len(archive)
     archive.sort(reverse=True)
-    seen_threadnos = get_seen_threadnos()
+    # loaded once: everything that is either sitting in the cache or was already fully downloaded
+    known_threadnos = get_known_threadnos()
     try:
         for index, thread_no in enumerate(archive[:_tries]):
-            if thread_no in seen_threadnos:
+            if thread_no in known_threadnos:
                 print(f"thread #{thread_no} has already been cached or downloaded. Skipping.")
+                api.metrics.inc("threads_skipped")
                 continue
             thread = api.get_thread(_board, thread_no)
-            matches = get_thread_name(thread).__contains__(_pattern)
+            api.metrics.inc("threads_scanned")
+            name = get_thread_name(thread)
+            matches = _pattern in name
             match_str = "\t\t\t ***MATCH***" if matches else ""
-            api.log(f"{index}: {thread_no} -> {get_thread_name(thread)} {match_str}", NORMAL)
+            api.log(f"{index}: {thread_no} -> {name} {match_str}", NORMAL)
 
             if matches:
-                cache_thread(thread)
-                sdg_threads.append(thread)
-
-            if _count and len(sdg_threads) >= _count:
-                return sdg_threads
+                api.metrics.inc("threads_matched")
+                cache_thread(thread, _board, [api.img_path])
+                known_threadnos.add(thread_no)
+                found += 1
+                yield thread
+
+            if _count and found >= _count:
+                return
     except KeyboardInterrupt:
         pass
 
-    return sdg_threads
-
 
-# side effect: removes items from cache that have been seen aka fully downloaded
-def mark_thread_as_seen(threadno: int):
-    if not os.path.isfile('seen_threads.json'):
-        with open('seen_threads.json', 'w') as f:
-            json.dump([], f)
-
-    # Load existing data
-    with open('seen_threads.json', 'r') as json_file:
-        try:
-            data = json.load(json_file)
-        except json.JSONDecodeError:
-            data = []
-
-    # Append new threads to existing data
-    data.append(threadno)
-
-    # Write back to the file
-    with open('seen_threads.json', 'w') as json_file:
-        json.dump(data, json_file)
-
-    # read contents of thread_cache into cache
-    with open('thread_cache.json', 'r') as json_file:
-        try:
-            cache = json.load(json_file)
-        except json.JSONDecodeError:
-            cache = []
+def find_matching(_board: str, _pattern: str, api: Api, _tries=None, _count=None) -> list[list[dict]]:
+    return list(iter_matching(_board, _pattern, api, _tries, _count))
+
+
+# one line of a --config job: threads on `board` whose title matches `regex` go to `outdir`
+class Rule:
+    def __init__(self, board: str, regex: str, outdir: str):
+        self.board = board
+        self.regex = re.compile(regex)
+        self.outdir = outdir
+
+    def __repr__(self):
+        return f"Rule(/{self.board}/ {self.regex.pattern!r} -> {self.outdir})"
+
+
+# config is a json file like:
+#   {"tries": 500, "rules": [{"board": "g", "pattern": "/sdg/", "outdir": "sdg"},
+#                            {"board": "g", "regex": "/(lmg|ldg)/", "outdir": "llm"}]}
+# "pattern" is a plain substring like -pattern, "regex" is used as is
+def load_rules(path: str) -> (list[Rule], dict):
+    with open(path, 'r') as f:
+        config = json.load(f)
+    rules = []
+    for r in config.get("rules", []):
+        regex = r["regex"] if "regex" in r else re.escape(r["pattern"])
+        rules.append(Rule(r["board"], regex, r["outdir"]))
+        os.makedirs(r["outdir"], exist_ok=True)
+    return rules, config
+
+
+# like iter_matching, but for any number of rules across any number of boards in one pass: each board's archive
+# and each thread are fetched at most once. all of a board's rules are compiled into one alternation so a
+# non-matching title (most of them) costs a single regex search. yields (board, thread, outdirs of matching rules)
+def iter_rule_matches(api: Api, rules: list[Rule], _tries=None) -> Iterator[tuple[str, list[dict], list[str]]]:
+    by_board = {}
+    for rule in rules:
+        by_board.setdefault(rule.board, []).append(rule)
+    known_threadnos = get_known_threadnos()
 
-    buf = []
-    for item in cache:
-        if get_thread_no(item) not in data:
-            buf.append(item)
+    try:
+        for board, board_rules in by_board.items():
+            api.log(f"looking for threads in /{board}/ matching {board_rules}", NORMAL)
+            try:
+                matcher = re.compile("|".join(f"(?:{rule.regex.pattern})" for rule in board_rules))
+            except re.error:
+                # e.g. rules with conflicting inline flags, just check them one by one
+                matcher = None
+            archive = api.get_archive_threadnos(board)
+            archive.sort(reverse=True)
+            for index, thread_no in enumerate(archive[:_tries]):
+                if thread_no in known_threadnos:
+                    api.metrics.inc("threads_skipped")
+                    continue
+                thread = api.get_thread(board, thread_no)
+                api.metrics.inc("threads_scanned")
+                name = get_thread_name(thread)
+                if matcher is not None and not matcher.search(name):
+                    api.log(f"{index}: {thread_no} -> {name}", NORMAL)
+                    continue
+                outdirs = [rule.outdir for rule in board_rules if rule.regex.search(name)]
+                match_str = f"\t\t\t ***MATCH*** -> {', '.join(outdirs)}" if outdirs else ""
+                api.log(f"{index}: {thread_no} -> {name} {match_str}", NORMAL)
+                if outdirs:
+                    api.metrics.inc("threads_matched")
+                    cache_thread(thread, board, outdirs)
+                    known_threadnos.add(thread_no)
+                    yield board, thread, outdirs
+    except KeyboardInterrupt:
+        pass
 
-    to_be_purged = list(map(get_thread_no, [c for c in cache if c not in buf]))
 
-    # effectively removes the no-longer-needed items in cache
-    with open('thread_cache.json', 'w') as json_file:
+# generals repost the same images all the time. if we already have a file with this post's md5 (in any thread or
+# outdir) it gets hardlinked into place instead of downloaded again, falling back to a local copy if the filesystem
+# can't hardlink. returns true if it found one, false if there's none or it couldn't be copied (then the image is
+# just downloaded)
+def link_known_img(api: Api, md5: str, path: str, prefix="") -> bool:
+    known_path = get_img_path(md5)
+    if known_path is None or not os.path.exists(known_path):
+        return False
+    try:
+        os.link(known_path, path)
+    except OSError:
         try:
-            json.dump(buf, json_file)
-            print(f"purged {len(to_be_purged)} items from cache: {to_be_purged}")
-        except json.JSONDecodeError:
-            print("failed to clear cache")
+            shutil.copyfile(known_path, path)
+        except OSError as e:
+            api.log(f"{prefix}couldn't copy {known_path} to {path} ({e}), downloading it instead", NORMAL)
+            # a partial copy would look like a finished file
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+    api.log(f"{prefix}{path} is a repost of {known_path}, linked it instead of downloading", NORMAL)
+    api.metrics.inc("img_linked")
+    return True
 
 
-def pop_thread_cache() -> list[list[dict]]:
-    with open('thread_cache.json', 'r') as json_file:
-        sdg_threads_json = json_file.read()
+# returns true if the image is on disk afterwards, false if the download failed and has to be retried
+def download_if_missing(api: Api, board: str, post: dict, prefix="", outdir=None) -> bool:
+    url = get_img_url(board, post)
+    path = api.img_url_to_path(url, outdir)
+    md5 = post.get("md5")
+    if os.path.exists(path):
+        api.log(f"{prefix}file {path} already exists, skipping...", NORMAL)
+        api.metrics.inc("img_exists")
+        # files from before the index (or from another copy of the archive) get indexed the first time we see them,
+        # so their reposts are linked. the size check keeps truncated files from older versions out of the index
+        if md5 and get_img_path(md5) is None and post.get("fsize") in (None, os.path.getsize(path)):
+            add_img(md5, path)
+        return True
+    if md5 and link_known_img(api, md5, path, prefix):
+        return True
+    if not api.queue_download(url, prefix, post, outdir):
+        return False
+    if md5:
+        add_img(md5, path)
+    return True
 
-    return json.loads(sdg_threads_json)
 
+def download_from_threads(api: Api, board: str, threads: Iterable[list[dict]], workers: int = 1,
+                          img_filter: ImgFilter = None) -> int:
+    return download_jobs(api, ((board, thread, [api.img_path]) for thread in threads), workers, img_filter)
 
-def download_from_threads(api: Api, board: str, threads: list[list[dict]]):
-    total_img_count = sum(1 for thread in threads for post in thread if has_img(post))
 
+# images from every thread go through one worker pool, so a slow multi-MB png doesn't hold up the rest.
+# the pool size only changes how many transfers overlap, the request rate is still capped by api.limiter.
+# jobs are (board, thread, outdirs) and can be a generator (see iter_matching), images are queued as each thread
+# comes in. an image that goes to several outdirs is downloaded once and linked into the others.
+# returns the number of threads that were downloaded
+def download_jobs(api: Api, jobs: Iterable[tuple[str, list[dict], list[str]]], workers: int = 1,
+                  img_filter: ImgFilter = None) -> int:
+    img_filter = img_filter if img_filter is not None else ImgFilter()
+    total_img_count = 0
     progress = 0
-    for i, thread in enumerate(threads):
-        thread_no = thread[0].get("no")
-        urls = get_img_urls_from_thread(board, thread)
-        api.log(f"downloading {len(urls)} files from thread {i+1}/{len(threads)}", NORMAL)
-        for url in urls:
-            progress += 1
-            path = api.img_url_to_path(url)
-            if not os.path.exists(path):
-                print(f"[{progress}/{total_img_count}] ", end="")
-                api.queue_download(url)
-            else:
-                api.log(f"file {path} already exists, skipping...", NORMAL)
+    progress_lock = threading.Lock()
 
-        api.log(f"%%%%% FULLY DOWNLOADED thread: {thread_no} %%%%%%", NORMAL)
-        # once fully downloaded, mark the thread as seen
-        mark_thread_as_seen(thread_no)
+    def _download(board: str, post: dict, outdirs: list[str]) -> bool:
+        nonlocal progress
+        with progress_lock:
+            progress += 1
+            prefix = f"[{progress}/{total_img_count}] "
+        return all([download_if_missing(api, board, post, prefix, outdir) for outdir in outdirs])
+
+    # marking as seen touches the db so it stays on this thread, in the order threads were queued.
+    # a thread with failed downloads stays in the cache instead, so --pop picks it up again
+    def _mark_done(pending: deque, block: bool):
+        while pending and (block or all(future.done() for future in pending[0][1])):
+            thread_no, futures = pending.popleft()
+            failed = sum(not future.result() for future in futures)
+            if failed:
+                api.log(f"thread #{thread_no}: {failed}/{len(futures)} images failed, leaving it in the cache "
+                        f"to resume with --pop", NORMAL)
+                continue
+            api.log(f"%%%%% FULLY DOWNLOADED thread: {thread_no} %%%%%%", NORMAL)
+            # once fully downloaded, mark the thread as seen
+            mark_thread_as_seen(thread_no)
+
+    num_threads = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool, \
+            ThreadPoolExecutor(max_workers=THUMB_WORKERS) as thumb_pool:
+        pending = deque()
+        for board, thread, outdirs in jobs:
+            num_threads += 1
+            posts = img_filter.select(get_img_posts_from_thread(thread), partial(api.get_thumbnail, board),
+                                      thumb_pool.map)
+            with progress_lock:
+                total_img_count += len(posts)
+            api.log(f"queueing {len(posts)} files from thread #{get_thread_no(thread)} ({num_threads})", NORMAL)
+            pending.append((get_thread_no(thread), [pool.submit(_download, board, post, outdirs) for post in posts]))
+            _mark_done(pending, block=False)
+
+        _mark_done(pending, block=True)
+
+    return num_threads
+
+
+# follows live threads instead of waiting for them to hit the archive.
+# every poll is one conditional request for threads.json; the catalog is only fetched when a thread we haven't
+# matched yet shows up, and a watched thread is only fetched when its last_modified moved. only posts newer than
+# the last one we saw are downloaded. idle threads and an idle board both back off up to WATCH_MAX_INTERVAL.
+# progress is saved per thread once its queued images are done, so a restart carries on where it stopped
+def watch(api: Api, board: str, pattern: str, workers: int = 1, img_filter: ImgFilter = None):
+    img_filter = img_filter if img_filter is not None else ImgFilter()
+    # last_post is what's been queued, saved_post what's been downloaded and saved to the db
+    state = {no: {"last_post": last_post, "saved_post": last_post, "last_modified": last_modified,
+                  "interval": WATCH_MIN_INTERVAL, "next_poll": 0.0}
+             for no, (last_post, last_modified) in get_watched(board).items()}
+    # thread numbers we've already decided about (watched, downloaded before, or not matching)
+    classified = get_known_threadnos() | set(state)
+    # thread_no -> deque of (futures, last_post, last_modified) batches not yet saved to the db
+    pending = {}
+    interval = WATCH_MIN_INTERVAL
+
+    def _queue_new_posts(pool: ThreadPoolExecutor, thumb_pool: ThreadPoolExecutor, thread_no: int, thread: list[dict],
+                         last_modified: int) -> bool:
+        st = state[thread_no]
+        new_posts = [post for post in thread if post.get("no", 0) > st["last_post"]]
+        if not new_posts:
+            return False
+        img_posts = img_filter.select(get_img_posts_from_thread(new_posts), partial(api.get_thumbnail, board),
+                                      thumb_pool.map)
+        api.log(f"thread #{thread_no}: {len(new_posts)} new posts, queueing {len(img_posts)} files", NORMAL)
+        st["last_post"] = max(post.get("no") for post in new_posts)
+        st["last_modified"] = last_modified
+        futures = [pool.submit(download_if_missing, api, board, post) for post in img_posts]
+        pending.setdefault(thread_no, deque()).append((futures, st["last_post"], last_modified))
+        return True
+
+    # a batch with failed downloads isn't saved: the thread is rewound to the last saved post and polled again,
+    # so the failed images get queued again (and a restart resumes from the saved post too)
+    def _save_done(block: bool):
+        for thread_no, batches in list(pending.items()):
+            while batches and (block or all(future.done() for future in batches[0][0])):
+                futures, last_post, last_modified = batches.popleft()
+                failed = sum(not future.result() for future in futures)
+                st = state[thread_no]
+                if failed:
+                    api.log(f"thread #{thread_no}: {failed}/{len(futures)} images failed, retrying them", NORMAL)
+                    st["last_post"] = st["saved_post"]
+                    st["last_modified"] = 0
+                    st["next_poll"] = 0.0
+                    # later batches were queued past the failed posts, they're redone from the rewound point.
+                    # whatever of them is already running has to finish first, or the re-queued posts would have two
+                    # workers writing the same .part file
+                    dropped = [future for futures, _, _ in batches for future in futures if not future.cancel()]
+                    wait(dropped)
+                    batches.clear()
+                    break
+                update_watched(thread_no, board, last_post, last_modified)
+                st["saved_post"] = last_post
+            if not batches:
+                del pending[thread_no]
+
+    api.log(f"watching /{board}/ for threads with title containing {pattern}, ctrl-c to stop", NORMAL)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool, \
+            ThreadPoolExecutor(max_workers=THUMB_WORKERS) as thumb_pool:
+        try:
+            while True:
+                live = api.get_live_threads(board)
+                changed = False
+                if live is not None:
+                    if any(thread_no not in classified for thread_no in live):
+                        for op in api.get_catalog(board):
+                            thread_no = op.get("no")
+                            if thread_no in classified:
+                                continue
+                            classified.add(thread_no)
+                            name = get_thread_name([op])
+                            if pattern in name:
+                                api.log(f"watching new thread #{thread_no} -> {name}", NORMAL)
+                                state[thread_no] = {"last_post": 0, "saved_post": 0, "last_modified": 0,
+                                                    "interval": WATCH_MIN_INTERVAL, "next_poll": 0.0}
+                                update_watched(thread_no, board, 0, 0)
+
+                    t_now = time.monotonic()
+                    for thread_no, st in list(state.items()):
+                        if thread_no not in live:
+                            # fell off the board: grab whatever was posted since the last poll, then retire it
+                            thread = api.get_thread(board, thread_no)
+                            if get_thread_no(thread):
+                                _queue_new_posts(pool, thumb_pool, thread_no, thread, st["last_modified"])
+                            failed = sum(not future.result() for futures, _, _ in pending.pop(thread_no, [])
+                                         for future in futures)
+                            del state[thread_no]
+                            if failed:
+                                # stays in the watched table at its last saved post, the next --watch run retries it
+                                api.log(f"thread #{thread_no}: {failed} images failed, will resume next time", NORMAL)
+                                continue
+                            api.log(f"%%%%% FULLY DOWNLOADED thread: {thread_no} %%%%%%", NORMAL)
+                            mark_thread_as_seen(thread_no)
+                            drop_watched(thread_no)
+                            continue
+
+                        if live[thread_no] <= st["last_modified"] or t_now < st["next_poll"]:
+                            continue
+                        thread = api.get_thread(board, thread_no)
+                        if not get_thread_no(thread):
+                            continue
+                        if _queue_new_posts(pool, thumb_pool, thread_no, thread, live[thread_no]):
+                            changed = True
+                            st["interval"] = WATCH_MIN_INTERVAL
+                        else:
+                            st["last_modified"] = live[thread_no]
+                            st["interval"] = min(st["interval"] * 2, WATCH_MAX_INTERVAL)
+                        st["next_poll"] = t_now + st["interval"]
+
+                _save_done(block=False)
+                interval = WATCH_MIN_INTERVAL if changed else min(interval * 2, WATCH_MAX_INTERVAL)
+                api.log(f"watching {len(state)} threads, next poll in {interval}s", DEBUG)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            api.log("stopping, waiting for queued downloads to finish...", NORMAL)
+            _save_done(block=True)
 
 
 if __name__ == "__main__":
@@ -278,6 +647,34 @@ if __name__ == "__main__":
                                                              'rather than successes. useful if you want to try to'
                                                              'download the entire archive')
 
+    parser.add_argument('--workers', type=int, default=4, help='number of images to download at the same time. '
+                                                               'requests are still rate limited to 1/s. default=4')
+
+    parser.add_argument('--watch', action="store_true", default=False, help='follow live threads from the catalog '
+                                                                            'and download new images as they are '
+                                                                            'posted, until ctrl-c')
+
+    # image filters, checked against the post metadata before anything is downloaded
+    parser.add_argument('--min-w', type=int, default=0, help='skip images narrower than this')
+    parser.add_argument('--min-h', type=int, default=0, help='skip images shorter than this')
+    parser.add_argument('--ext', nargs='+', default=None, help='only download these extensions, e.g. --ext png jpg')
+    parser.add_argument('--max-fsize', type=int, default=None, help='skip files bigger than this many bytes')
+    parser.add_argument('--filename', type=str, default=None, help='only download images whose original filename '
+                                                                   'matches this regex')
+    parser.add_argument('--classifier', type=str, default=None, help='module:function that gets batches of '
+                                                                     '(posts, thumbnails) and returns a list of bools. '
+                                                                     'only accepted posts are downloaded full size')
+
+    parser.add_argument('--config', type=str, default=None, help='json file with several (board, pattern, outdir) '
+                                                                 'rules to run in a single pass, see README')
+
+    parser.add_argument('--progress', type=float, default=0, help='print a stats line (bytes, MB/s, downloads, '
+                                                                  'rate limiter wait) every N seconds')
+    parser.add_argument('--metrics', type=str, default=None, help='write a summary of the run (request latency '
+                                                                  'histograms, bytes, counters) to this file at '
+                                                                  'exit. json, or prometheus textfile if it ends '
+                                                                  'in .prom')
+
     parser.add_argument('--inspect', action="store_true", default=False, help='inspect the current cache')
 
     args = parser.parse_args()
@@ -299,22 +696,75 @@ if __name__ == "__main__":
     tries = None if args.tries == 0 else args.tries
     board = args.board
     pattern = args.pattern
-    api = Api(outdir=args.outdir, ratelimit=1)
-
+    api = Api(outdir=args.outdir, ratelimit=1, workers=args.workers)
+
+    if args.progress:
+        api.metrics.start_reporter(args.progress, lambda line: api.log(line, NORMAL))
+
+    # runs on every exit path below, including ctrl-c
+    def _report_metrics():
+        api.metrics.stop()
+        api.log(api.metrics.progress_line(), NORMAL)
+        if args.metrics:
+            api.metrics.write(args.metrics)
+            api.log(f"wrote run metrics to {args.metrics}", NORMAL)
+
+    atexit.register(_report_metrics)
+
+    img_filter = ImgFilter(classifier=load_classifier(args.classifier) if args.classifier else None)
+    if args.min_w or args.min_h:
+        img_filter.add(min_size(args.min_w, args.min_h))
+    if args.ext:
+        img_filter.add(ext_in(*args.ext))
+    if args.max_fsize:
+        img_filter.add(fsize_between(hi=args.max_fsize))
+    if args.filename:
+        img_filter.add(filename_matches(args.filename))
+
+    # cached threads are resumed as the job they were cached for: their own board and outdirs, whatever
+    # -board/-outdir/--config say now (threads cached before those were stored fall back to -board/-outdir)
     if args.pop:
-        target_threads = pop_thread_cache()
-        api.log(f"found {len(target_threads)} threads to download from cache.", NORMAL)
-    else:
-        target_threads = find_matching(board, pattern, api, tries, args.count)
+        jobs = [(job_board or board, thread, outdirs or [api.img_path])
+                for job_board, thread, outdirs in pop_cached_jobs()]
+        for _, _, outdirs in jobs:
+            for outdir in outdirs:
+                os.makedirs(outdir, exist_ok=True)
+        api.log(f"found {len(jobs)} threads to download from cache.", NORMAL)
+        num_threads = download_jobs(api, jobs, args.workers, img_filter)
         api.log("="*20, NORMAL)
-        api.log(f"found {len(target_threads)} matching threads in /{board}/ archive...", NORMAL)
+        api.log(f"downloaded images from {num_threads} cached threads", NORMAL)
+        api.log("done :3", NORMAL)
+        exit(0)
+
+    if args.config:
+        rules, config = load_rules(args.config)
+        jobs = iter_rule_matches(api, rules, tries if tries is not None else config.get("tries"))
+        if args.cache:
+            successes = len(list(jobs))
+            api.log(f"cached {successes} new threads", NORMAL)
+        else:
+            num_threads = download_jobs(api, jobs, args.workers, img_filter)
+            api.log(f"downloaded images from {num_threads} threads matching {len(rules)} rules", NORMAL)
+        exit(0)
+
+    if args.watch:
+        watch(api, board, pattern, args.workers, img_filter)
+        exit(0)
+
+    # matches are downloaded while the archive scan keeps going
+    target_threads = iter_matching(board, pattern, api, tries, args.count)
 
     if args.cache:
+        target_threads = list(target_threads)
+        api.log("="*20, NORMAL)
+        api.log(f"found {len(target_threads)} threads to cache...", NORMAL)
         successes = cache_threads(target_threads)
         api.log(f"cached {successes} new threads, found {len(target_threads) - successes} "
                 f"duplicates sitting in cache", NORMAL)
     else:
-        download_from_threads(api, board, target_threads)
+        num_threads = download_from_threads(api, board, target_threads, args.workers, img_filter)
+        api.log("="*20, NORMAL)
+        api.log(f"downloaded images from {num_threads} threads in /{board}/", NORMAL)
         api.log("done :3", NORMAL)
 
 
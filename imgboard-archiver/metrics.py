@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+
+# upper bounds (seconds) of the request latency histogram buckets, prometheus style (cumulative, +Inf implied)
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+# counters + latency histograms for one run, shared by the Api and all download workers.
+# counters are free-form names ("img_downloaded", "img_exists", "http_not_modified", ...) so new call sites
+# don't need to touch this class
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_t = time.monotonic()
+        self.counters = {}
+        # kind ("json", "img", "thumb") -> [bucket counts..., +Inf count], sum, count
+        self.histograms = {}
+        self.bytes_downloaded = 0
+        self.limiter_sleep = 0.0
+
+    def inc(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, kind: str, seconds: float):
+        with self.lock:
+            hist = self.histograms.setdefault(kind, {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0,
+                                                     "count": 0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+            hist["buckets"][-1] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def add_bytes(self, n: int):
+        with self.lock:
+            self.bytes_downloaded += n
+
+    def add_sleep(self, seconds: float):
+        with self.lock:
+            self.limiter_sleep += seconds
+
+    def summary(self) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.start_t
+            return {
+                "elapsed_s": round(elapsed, 3),
+                "bytes_downloaded": self.bytes_downloaded,
+                "throughput_bytes_per_s": round(self.bytes_downloaded / elapsed, 1) if elapsed else 0,
+                "limiter_sleep_s": round(self.limiter_sleep, 3),
+                "counters": dict(self.counters),
+                "latency": {kind: {"count": h["count"],
+                                   "mean_s": round(h["sum"] / h["count"], 4) if h["count"] else 0,
+                                   "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], h["buckets"]))}
+                            for kind, h in self.histograms.items()},
+            }
+
+    def progress_line(self) -> str:
+        s = self.summary()
+        c = s["counters"]
+        return (f"[stats] {s['elapsed_s']:.0f}s, {s['bytes_downloaded'] / 1e6:.1f}MB "
+                f"({s['throughput_bytes_per_s'] / 1e6:.2f}MB/s), "
+                f"{c.get('img_downloaded', 0)} downloaded, {c.get('img_exists', 0)} already there, "
+                f"{c.get('img_linked', 0)} linked reposts, {c.get('img_failed', 0)} failed, "
+                f"{s['limiter_sleep_s']:.0f}s waiting on the rate limiter")
+
+    # prints progress_line every `interval` seconds on a daemon thread until stop() is called
+    def start_reporter(self, interval: float = 5, log=print):
+        self._stop = threading.Event()
+
+        def _report():
+            while not self._stop.wait(interval):
+                log(self.progress_line())
+
+        threading.Thread(target=_report, daemon=True).start()
+
+    def stop(self):
+        if getattr(self, "_stop", None) is not None:
+            self._stop.set()
+
+    # *.prom -> prometheus textfile (for node_exporter's textfile collector), anything else -> json
+    def write(self, path: str):
+        if path.endswith(".prom"):
+            self.write_prometheus(path)
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path: str):
+        s = self.summary()
+        lines = [
+            "# TYPE imgboard_bytes_downloaded_total counter",
+            f"imgboard_bytes_downloaded_total {s['bytes_downloaded']}",
+            "# TYPE imgboard_limiter_sleep_seconds_total counter",
+            f"imgboard_limiter_sleep_seconds_total {s['limiter_sleep_s']}",
+            "# TYPE imgboard_run_seconds gauge",
+            f"imgboard_run_seconds {s['elapsed_s']}",
+            "# TYPE imgboard_events_total counter",
+        ]
+        lines += [f'imgboard_events_total{{event="{name}"}} {n}' for name, n in sorted(s["counters"].items())]
+        lines.append("# TYPE imgboard_request_seconds histogram")
+        with self.lock:
+            for kind, h in sorted(self.histograms.items()):
+                for bound, n in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], h["buckets"]):
+                    lines.append(f'imgboard_request_seconds_bucket{{kind="{kind}",le="{bound}"}} {n}')
+                lines.append(f'imgboard_request_seconds_sum{{kind="{kind}"}} {h["sum"]}')
+                lines.append(f'imgboard_request_seconds_count{{kind="{kind}"}} {h["count"]}')
+        # write then rename so the collector never reads a half-written file
+        with open(path + ".tmp", 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,201 @@
+import sqlite3
+import json
+import os
+import time
+import threading
+
+# local state lives in one sqlite file instead of rewriting thread_cache.json / seen_threads.json on every change.
+# thread number is the primary key everywhere, so insert / lookup / purge are single indexed statements,
+# and every change is its own transaction so killing the process mid-run can't leave a half-written cache.
+# each thread gets its own connection (download workers write to the image index), WAL lets them share the file
+DB_PATH = "archive.db"
+
+# the old json files, only read once to migrate them into the db
+CACHE_JSON = "thread_cache.json"
+SEEN_JSON = "seen_threads.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    no INTEGER PRIMARY KEY,
+    posts TEXT NOT NULL,
+    board TEXT,
+    outdirs TEXT
+);
+CREATE TABLE IF NOT EXISTS seen (
+    no INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS http_cache (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watched (
+    no INTEGER PRIMARY KEY,
+    board TEXT NOT NULL,
+    last_post INTEGER NOT NULL,
+    last_modified INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    md5 TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_local = threading.local()
+
+
+def get_db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        db = sqlite3.connect(DB_PATH, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(SCHEMA)
+        # dbs from before cached threads remembered where they were going
+        columns = [row[1] for row in db.execute("PRAGMA table_info(threads)")]
+        for column in ("board", "outdirs"):
+            if column not in columns:
+                try:
+                    db.execute(f"ALTER TABLE threads ADD COLUMN {column} TEXT")
+                except sqlite3.OperationalError:
+                    # another thread's connection added it first
+                    pass
+        migrate_json(db)
+        _local.db = db
+    return db
+
+
+# point this thread at a different db file (e.g. a scratch one for bench.py), opened lazily on next use
+def use_db(path: str):
+    global DB_PATH
+    db = getattr(_local, "db", None)
+    if db is not None:
+        db.close()
+        _local.db = None
+    DB_PATH = path
+
+
+def _load_json_list(path: str) -> list:
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as json_file:
+        try:
+            data = json.load(json_file)
+        except json.JSONDecodeError:
+            data = []
+    return data if isinstance(data, list) else []
+
+
+# one-time import of thread_cache.json and seen_threads.json, the json files are left alone afterwards
+def migrate_json(db: sqlite3.Connection):
+    if db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+        return
+
+    threads = [t for t in _load_json_list(CACHE_JSON) if t and t[0] and t[0].get("no") is not None]
+    seen = [no for no in _load_json_list(SEEN_JSON) if isinstance(no, int)]
+    with db:
+        db.executemany("INSERT OR IGNORE INTO threads (no, posts) VALUES (?, ?)",
+                       [(t[0].get("no"), json.dumps(t)) for t in threads])
+        db.executemany("INSERT OR IGNORE INTO seen (no) VALUES (?)", [(no,) for no in seen])
+        db.execute("DELETE FROM threads WHERE no IN (SELECT no FROM seen)")
+        db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('migrated', ?)", (str(int(time.time())),))
+
+    if threads or seen:
+        print(f"migrated {len(threads)} cached threads and {len(seen)} seen threads from json into {DB_PATH}")
+
+
+# (etag, last_modified, body) from the last 200 response for url, or None
+def get_http_cache(url: str):
+    return get_db().execute("SELECT etag, last_modified, body FROM http_cache WHERE url = ?", (url,)).fetchone()
+
+
+def put_http_cache(url: str, etag, last_modified, body: str):
+    db = get_db()
+    with db:
+        db.execute("INSERT OR REPLACE INTO http_cache (url, etag, last_modified, body) VALUES (?, ?, ?, ?)",
+                   (url, etag, last_modified, body))
+
+
+# thread numbers currently sitting in the cache (not downloaded yet)
+def get_seen_threadnos() -> list[int]:
+    return [row[0] for row in get_db().execute("SELECT no FROM threads")]
+
+
+# every thread number we don't need to fetch again: cached ones plus ones that were already fully downloaded
+def get_known_threadnos() -> set[int]:
+    return {row[0] for row in get_db().execute("SELECT no FROM threads UNION SELECT no FROM seen")}
+
+
+# adds a thread to the cache if it's not there already, with the board it's from and the outdirs its images go to
+# so it can be resumed as the same job later. returns true if a new unique thread was cached
+def cache_thread(thread: list[dict], board: str = None, outdirs: list[str] = None) -> bool:
+    db = get_db()
+    with db:
+        cur = db.execute("INSERT OR IGNORE INTO threads (no, posts, board, outdirs) VALUES (?, ?, ?, ?)",
+                         (thread[0].get("no"), json.dumps(thread), board,
+                          json.dumps(outdirs) if outdirs is not None else None))
+    return cur.rowcount == 1
+
+
+# returns the number of new threads that were cached
+def cache_threads(threads: list[list[dict]]) -> int:
+    s = 0
+    for thread in threads:
+        s += 1 if cache_thread(thread) else 0
+    return s
+
+
+# side effect: removes the thread from the cache now that it's been seen aka fully downloaded
+def mark_thread_as_seen(threadno: int):
+    db = get_db()
+    with db:
+        db.execute("INSERT OR IGNORE INTO seen (no) VALUES (?)", (threadno,))
+        purged = db.execute("DELETE FROM threads WHERE no = ?", (threadno,)).rowcount
+    if purged:
+        print(f"purged {purged} items from cache: {[threadno]}")
+
+
+def pop_thread_cache() -> list[list[dict]]:
+    return [json.loads(row[0]) for row in get_db().execute("SELECT posts FROM threads ORDER BY no")]
+
+
+# the cache as (board, thread, outdirs) jobs. board / outdirs are None for threads cached before they were stored
+def pop_cached_jobs() -> list[tuple]:
+    rows = get_db().execute("SELECT board, posts, outdirs FROM threads ORDER BY no")
+    return [(board, json.loads(posts), json.loads(outdirs) if outdirs else None) for board, posts, outdirs in rows]
+
+
+# live threads followed by --watch: {thread_no: (last downloaded post no, last_modified we saw)}
+def get_watched(board: str) -> dict[int, tuple[int, int]]:
+    rows = get_db().execute("SELECT no, last_post, last_modified FROM watched WHERE board = ?", (board,))
+    return {no: (last_post, last_modified) for no, last_post, last_modified in rows}
+
+
+def update_watched(threadno: int, board: str, last_post: int, last_modified: int):
+    db = get_db()
+    with db:
+        db.execute("INSERT OR REPLACE INTO watched (no, board, last_post, last_modified) VALUES (?, ?, ?, ?)",
+                   (threadno, board, last_post, last_modified))
+
+
+def drop_watched(threadno: int):
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM watched WHERE no = ?", (threadno,))
+
+
+# content-addressed index of every image we've downloaded, keyed by the base64 md5 the api gives for each post
+def get_img_path(md5: str):
+    row = get_db().execute("SELECT path FROM images WHERE md5 = ?", (md5,)).fetchone()
+    return row[0] if row else None
+
+
+def add_img(md5: str, path: str):
+    db = get_db()
+    with db:
+        db.execute("INSERT OR REPLACE INTO images (md5, path) VALUES (?, ?)", (md5, os.path.abspath(path)))
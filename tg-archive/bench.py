@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import resource
+import contextlib
+import multiprocessing
+
+import main
+from fake_client import FakeChat, FakeClient
+
+# end-to-end benchmarks against fake_client.py, so changes to archive_chat / the media downloads / the store can be
+# measured offline and tracked over time. every scenario runs in its own process (peak RSS is per scenario) in a
+# fresh scratch dir, for each chat size given.
+#
+#   python bench.py                                     # everything with the defaults
+#   python bench.py archive --sizes 1000 100000         # pick scenarios and chat sizes
+#   python bench.py multi --latency=0.05 --flood-rate=0.01 --out=bench.json
+
+# first run over one chat: every message fetched, stored, rendered, and its media downloaded
+async def scenario_archive(tgc, chats, args):
+    await run_targets(tgc, chats, args)
+
+# the same with THUMBNAILS_ONLY
+async def scenario_thumbs(tgc, chats, args):
+    main.THUMBNAILS_ONLY = True
+    await run_targets(tgc, chats, args)
+
+# --chats chats at once sharing the client and the request cap
+async def scenario_multi(tgc, chats, args):
+    await run_targets(tgc, chats, args)
+
+# a second run with nothing new: the incremental path should cost a request, not a re-archive
+async def scenario_rerun(tgc, chats, args):
+    await run_targets(tgc, chats, args)
+    tgc.reset_counters()
+    args.t_start = time.monotonic()
+    await run_targets(tgc, chats, args)
+
+# re-rendering the html from the store, no client involved
+async def scenario_rebuild(tgc, chats, args):
+    await run_targets(tgc, chats, args)
+    tgc.reset_counters()
+    args.t_start = time.monotonic()
+    main.rebuild_chat_html(main.ChatOutput(chats[0].name).name)
+    return {"messages": chats[0].num_messages}
+
+async def run_targets(tgc, chats, args):
+    senders = main.SenderCache(tgc)
+    limiter = main.RequestLimiter(args.parallel)
+    dedup = main.MediaDedup()
+    dialogs = await tgc.get_dialogs()
+    await asyncio.gather(*[main.archive_target(tgc, chat, senders, limiter, dedup)
+                           for chat in dialogs if chat.entity in chats])
+    dedup.close()
+
+def _run(name, size, args, results):
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+        os.chdir(tmp)
+        media_size = (args.media_kb[0] * 1024, args.media_kb[1] * 1024)
+        chats = [FakeChat(f"bench chat {i}", size, photo_ratio=args.photo_ratio, doc_ratio=args.doc_ratio,
+                          forward_ratio=args.forward_ratio, media_size=media_size, seed=i)
+                 for i in range(args.chats if name == "multi" else 1)]
+        tgc = FakeClient(chats, latency=args.latency, flood_rate=args.flood_rate, flood_seconds=args.flood_seconds)
+        args.t_start = time.monotonic()
+        with contextlib.redirect_stdout(devnull):
+            res = asyncio.run(SCENARIOS[name](tgc, chats, args)) or {}
+        wall = time.monotonic() - args.t_start
+        res["wall_s"] = round(wall, 4)
+        res.setdefault("messages", tgc.messages_served)
+        res["msgs_per_s"] = round(res["messages"] / wall, 1) if wall else 0
+        res["media_files"] = tgc.downloads
+        res["media_mb"] = round(tgc.bytes_downloaded / 1e6, 2)
+        res["media_mb_per_s"] = round(tgc.bytes_downloaded / 1e6 / wall, 2) if wall else 0
+        res["requests"] = tgc.num_requests
+        res["peak_in_flight"] = tgc.peak_in_flight
+        res["flood_waits"] = tgc.flood_waits
+        # linux reports KB
+        res["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        results.put(res)
+
+def run_scenario(name, size, args):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run, args=(name, size, args, results))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        sys.exit(f"scenario {name} ({size} messages) crashed")
+    res = results.get()
+    return {"scenario": name, "size": size} | res
+
+SCENARIOS = {"archive": scenario_archive, "thumbs": scenario_thumbs, "multi": scenario_multi,
+             "rerun": scenario_rerun, "rebuild": scenario_rebuild}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline benchmarks for tg-archive against a fake telegram client")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f'any of {list(SCENARIOS)}')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='messages per chat')
+    parser.add_argument('--chats', type=int, default=4, help='chats archived at once in the multi scenario')
+    parser.add_argument('--photo-ratio', type=float, default=0.1, help='fraction of messages with a photo')
+    parser.add_argument('--doc-ratio', type=float, default=0.02, help='fraction of messages with a document')
+    parser.add_argument('--forward-ratio', type=float, default=0.1, help='fraction of media that are forwards')
+    parser.add_argument('--media-kb', type=int, nargs=2, default=[20, 200], help='min/max media size in KB')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake client waits per request')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='fraction of requests that hit a FloodWait')
+    parser.add_argument('--flood-seconds', type=float, default=0.5, help='how long each FloodWait is')
+    parser.add_argument('--parallel', type=int, default=main.DEFAULT_PARALLEL_DOWNLOADS, help='request cap')
+    parser.add_argument('--out', type=str, default=None, help='also write the results to this json file')
+    args = parser.parse_args()
+
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        sys.exit(f"unknown scenarios: {unknown}")
+
+    all_results = []
+    for name in args.scenarios:
+        for size in args.sizes:
+            res = run_scenario(name, size, args)
+            all_results.append(res)
+            print(json.dumps(res))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"args": vars(args), "time": time.time(), "results": all_results}, f, indent=2)
+        print(f"wrote results to {args.out}")
@@ -8,6 +8,11 @@ TG_API_HASH = None
 TG_PHONE_NUMBER = None
 CHAT_TARGETS = None
 MAX_MESSAGES_PER_CHAT = None
+MAX_PARALLEL_DOWNLOADS = None
+SENDER_CACHE_FILE = None
+MESSAGES_PER_PAGE = None
+EXPORT_JSONL = False
+THUMBNAILS_ONLY = False
 
 # example:
 # TG_API_KEY = "123456789"
@@ -15,3 +20,8 @@ MAX_MESSAGES_PER_CHAT = None
 # TG_PHONE_NUMBER = "+696969696969"
 # CHAT_TARGETS = ["frens gc 2023"]
 # MAX_MESSAGES_PER_CHAT = 100 
+# MAX_PARALLEL_DOWNLOADS = 8
+# SENDER_CACHE_FILE = "senders.json"
+# MESSAGES_PER_PAGE = 5000
+# EXPORT_JSONL = True
+# THUMBNAILS_ONLY = True
@@ -0,0 +1,150 @@
+import os
+import random
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+
+# a stand-in for TelegramClient so archive_chat / download_chat_media / the store can be measured without a telegram
+# account. serves synthetic chats whose messages (senders, replies, photos, documents) are generated on request from
+# their id, so a 100k message chat costs nothing until it's read. covers the bits of the client main.py uses:
+#   start, get_me, get_dialogs, get_messages (min_id/reverse paging, add_offset, ids), iter_participants,
+#   download_media (photos, their thumb sizes, documents)
+# every request can be delayed by `latency`, and a `flood_rate` fraction of downloads raise FloodWaitError
+# (telethon sleeps through FloodWaits on message requests by itself, so those just get slower instead)
+#
+#   tgc = FakeClient([FakeChat("bench chat", 10_000)], latency=0.02)
+
+START_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+class FakeChat:
+    def __init__(self, name, num_messages=1000, num_senders=50, reply_ratio=0.2, photo_ratio=0.1, doc_ratio=0.02,
+                 forward_ratio=0.0, media_size=(20_000, 200_000), seed=0):
+        self.name = name
+        self.num_messages = num_messages
+        self.num_senders = num_senders
+        self.reply_ratio = reply_ratio
+        self.photo_ratio = photo_ratio
+        self.doc_ratio = doc_ratio
+        self.forward_ratio = forward_ratio
+        self.media_size = media_size
+        self.seed = seed
+
+    # the same id always gives the same message
+    def message(self, client, msg_id):
+        rng = random.Random(self.seed * 1_000_003 + msg_id)
+        sender_id = 1000 + rng.randrange(self.num_senders)
+        reply_to = rng.randrange(1, msg_id) if msg_id > 1 and rng.random() < self.reply_ratio else None
+        photo = document = None
+        roll = rng.random()
+        # forwards reuse a small pool of media ids, like the same meme making the rounds
+        media_id = rng.randrange(1, 50) if rng.random() < self.forward_ratio else self.seed * 10**9 + msg_id
+        size = rng.randint(*self.media_size)
+        if roll < self.photo_ratio:
+            photo = types.Photo(id=media_id, access_hash=0, file_reference=b"", date=START_DATE, dc_id=2,
+                                sizes=[types.PhotoSize("s", 90, 90, size // 100),
+                                       types.PhotoSize("m", 320, 320, size // 10),
+                                       types.PhotoSize("x", 800, 800, size)])
+        elif roll < self.photo_ratio + self.doc_ratio:
+            document = types.Document(id=media_id, access_hash=0, file_reference=b"", date=START_DATE, dc_id=2,
+                                      mime_type="application/pdf", size=size,
+                                      attributes=[types.DocumentAttributeFilename(f"file_{media_id}.pdf")])
+        return FakeMessage(client, msg_id, START_DATE + timedelta(minutes=msg_id), sender_id, reply_to,
+                           f"message {msg_id} " + "lorem ipsum " * rng.randrange(1, 20), photo, document)
+
+class FakeMessage:
+    def __init__(self, client, msg_id, date, sender_id, reply_to, text, photo, document):
+        self.client = client
+        self.id = msg_id
+        self.date = date
+        self.sender_id = sender_id
+        self.reply_to_msg_id = reply_to
+        self.text = text
+        self.photo = photo
+        self.document = document
+
+    async def get_sender(self):
+        await self.client._request()
+        return SimpleNamespace(id=self.sender_id, username=f"user{self.sender_id}")
+
+class FakeClient:
+    def __init__(self, chats, latency=0.0, flood_rate=0.0, flood_seconds=0.5, seed=0):
+        self.chats = chats
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rng = random.Random(seed)
+        self.in_flight = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.num_requests = 0
+        self.messages_served = 0
+        self.downloads = 0
+        self.bytes_downloaded = 0
+        self.flood_waits = 0
+        self.peak_in_flight = 0
+
+    async def _request(self):
+        self.num_requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+    def _flood(self):
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.flood_waits += 1
+            return True
+        return False
+
+    async def start(self, phone=None):
+        return self
+
+    async def get_me(self):
+        return SimpleNamespace(id=1, username="bench")
+
+    async def get_dialogs(self):
+        await self._request()
+        return [SimpleNamespace(id=i + 1, name=chat.name, entity=chat) for i, chat in enumerate(self.chats)]
+
+    async def iter_participants(self, chat):
+        await self._request()
+        for i in range(chat.num_senders):
+            yield SimpleNamespace(id=1000 + i, username=f"user{1000 + i}")
+
+    async def get_messages(self, chat, limit=None, min_id=0, reverse=False, add_offset=0, ids=None):
+        await self._request()
+        if self._flood():
+            await asyncio.sleep(self.flood_seconds)
+        if ids is not None:
+            msgs = [chat.message(self, i) if 1 <= i <= chat.num_messages else None for i in ids]
+        elif reverse:
+            first = max(min_id, 0) + 1
+            msgs = [chat.message(self, i) for i in range(first, min(first + limit, chat.num_messages + 1))]
+        else:
+            top = chat.num_messages - add_offset
+            msgs = [chat.message(self, i) for i in range(top, max(top - limit, 0), -1)]
+        self.messages_served += sum(msg is not None for msg in msgs)
+        return msgs
+
+    async def download_media(self, media, file, thumb=None):
+        await self._request()
+        if self._flood():
+            e = FloodWaitError(None)
+            e.seconds = self.flood_seconds
+            raise e
+        size = thumb.size if thumb is not None else media.size if isinstance(media, types.Document) \
+            else media.sizes[-1].size
+        # same media id -> same bytes, so forwards and re-downloads hash the same
+        data = (media.id.to_bytes(8, "little") * (size // 8 + 1))[:size]
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, 'wb') as f:
+            f.write(data)
+        self.downloads += 1
+        self.bytes_downloaded += size
+        return file
@@ -1,69 +1,540 @@
 import asyncio
 from config import TG_API_KEY,TG_API_HASH, TG_PHONE_NUMBER, CHAT_TARGETS, MAX_MESSAGES_PER_CHAT
-from telethon import TelegramClient
+from config import MAX_PARALLEL_DOWNLOADS, SENDER_CACHE_FILE, MESSAGES_PER_PAGE, EXPORT_JSONL, THUMBNAILS_ONLY
+from telethon import TelegramClient, utils
+from telethon.errors import FloodWaitError, RPCError
 import os
+import sys
+import json
+import shutil
+import hashlib
+from datetime import datetime
+from collections import Counter
+import store
 
-IMG_DIR = "./images"
-DOC_DIR = "./documents"
-
-async def fmt_msg_html(msg, chat_dict, tgc: TelegramClient, include_reply=True):
-    _text = msg.text
-    _from = (await msg.get_sender()).username
-    _date = msg.date
-    reply_to = None
-    if include_reply:
-        reply_to = msg.reply_to_msg_id
-        _reply_txt = None
-        if reply_to is not None:
-            _reply = chat_dict[reply_to]
-            _reply_txt = chat_dict[reply_to].text
-            _reply_from = (await _reply.get_sender()).username
-
-    _document = msg.document
-    _photo = msg.photo
-
-    if _document is not None:
-        _filename = _document.attributes[0].file_name
+# how many requests (message pages, media downloads, participant lists) can be in flight at once, across all chats,
+# if config.py doesn't say
+DEFAULT_PARALLEL_DOWNLOADS = 8
+# messages per get_messages request (telegram's max)
+MESSAGES_PER_REQUEST = 100
+# give up on a file after this many FloodWaits
+MAX_FLOOD_RETRIES = 5
+# html page size if config.py doesn't say
+DEFAULT_MESSAGES_PER_PAGE = 5000
+# messages fetched before their media is downloaded and they're written out
+CHUNK_MESSAGES = 200
+# media dedup index shared by every chat folder
+MEDIA_INDEX_FILE = "media.db"
+# photo sizes used as the inline thumbnail in THUMBNAILS_ONLY mode, first one the photo has wins
+# ('m' fits in 320x320, just over the 250px the html shows)
+THUMB_SIZE_TYPES = ("m", "x", "s")
+
+# when telegram hands out a FloodWait it applies to the whole account, so every download waits it out,
+# not just the one that got the error
+class FloodGate:
+    def __init__(self):
+        self.until = 0
+
+    async def wait(self):
+        delay = self.until - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def hit(self, seconds):
+        self.until = max(self.until, asyncio.get_running_loop().time() + seconds)
+
+# shared by every chat being archived: at most `max_requests` requests in flight across all of them,
+# and a FloodWait hit by any of them pauses all of them
+class RequestLimiter:
+    def __init__(self, max_requests):
+        self.sem = asyncio.Semaphore(max_requests)
+        self.gate = FloodGate()
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+        await self.gate.wait()
+
+    async def __aexit__(self, *exc):
+        self.sem.release()
+
+# where one chat's archive goes: ./chat_name/ with the html pages, archive_state.json, images/ and documents/
+# chats whose names only differ in case or spaces vs underscores would share a folder (and its state file), so those
+# get the chat id appended, see chat_outputs
+class ChatOutput:
+    def __init__(self, chat_name, chat_id=None):
+        self.name = chat_name.lower().replace(' ', '_')
+        if chat_id is not None:
+            self.name += f"_{chat_id}"
+        self.img_dir = os.path.join(self.name, "images")
+        self.doc_dir = os.path.join(self.name, "documents")
+
+# sender id -> username. filled in bulk from the chat's participant list, so formatting a message is a dict lookup
+# instead of a get_sender() round trip per message (and another one for the message it replies to).
+# anyone not in the participant list (left the chat, channel posts, ...) is resolved once and then remembered.
+# with a path it's saved to disk between runs. messages without a sender (sender_id None, e.g. some outgoing private
+# messages) are never cached, json would turn the key into "null"
+class SenderCache:
+    def __init__(self, tgc: TelegramClient, path=None):
+        self.tgc = tgc
+        self.path = path
+        self.names = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                # (older versions could write a "null" key)
+                self.names = {int(k): v for k, v in json.load(f).items() if k != "null"}
+
+    async def prefetch(self, chat, limiter: RequestLimiter):
+        try:
+            async with limiter:
+                async for user in self.tgc.iter_participants(chat):
+                    self.names[user.id] = user.username
+        except RPCError as e:
+            # e.g. broadcast channels where we aren't an admin, senders get resolved one by one instead
+            print(f"couldn't list participants ({e.__class__.__name__}), resolving senders as they come up")
+
+    async def username(self, msg):
+        if msg.sender_id is None:
+            return None
+        if msg.sender_id in self.names:
+            return self.names[msg.sender_id]
+        sender = await msg.get_sender()
+        username = getattr(sender, "username", None)
+        self.names[msg.sender_id] = username
+        return username
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                json.dump({k: v for k, v in self.names.items() if k is not None}, f)
+
+# every saved file starts with the media id and has its extension already, so telethon saves to exactly this
+# path and a later run can tell the file is already there
+def media_save_path(msg, out: ChatOutput):
+    if msg.document is not None:
+        _filename = getattr(msg.document.attributes[0], "file_name", None) if msg.document.attributes else None
         if not _filename:
-            _filename = _document.id
-        _save_path = os.path.join(DOC_DIR, _filename)
-        doc_path = await tgc.download_media(_document, file=_save_path)
-        doc_path= os.path.join(os.getcwd(), doc_path)
-
-    if _photo is not None:
-        _filename = str(_photo.id)
-        _save_path = os.path.join(IMG_DIR, _filename)
-        img_path = await tgc.download_media(_photo, file=_save_path)
-        img_path = os.path.join(os.getcwd(), img_path)
-
-    h_img = f"<img src='{img_path}'/>" if _photo is not None else ""
+            _filename = utils.get_extension(msg.document)
+        return os.path.join(out.doc_dir, f"{msg.document.id}_{_filename}")
+    if msg.photo is not None:
+        return os.path.join(out.img_dir, str(msg.photo.id) + utils.get_extension(msg.photo))
+    return None
+
+# the photo size to download instead of the full photo, None if it has none of THUMB_SIZE_TYPES
+def pick_thumb(photo):
+    sizes = {getattr(size, "type", None): size for size in photo.sizes}
+    return next((sizes[t] for t in THUMB_SIZE_TYPES if t in sizes), None)
+
+def thumb_save_path(msg, thumb, out: ChatOutput):
+    return os.path.join(out.img_dir, f"{msg.photo.id}_{thumb.type}.jpg")
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# media is downloaded once no matter how many chats it shows up in. a forward keeps its photo/document id, so it's
+# found by id before anything is downloaded. anything else is hashed after downloading, and if the same bytes are
+# already archived somewhere the new file is swapped for a hardlink to the old one
+class MediaDedup:
+    def __init__(self, path=MEDIA_INDEX_FILE):
+        self.db = store.open_media_index(path)
+        # key -> Event set when its download finishes, so the same forward turning up in two chats at once
+        # is still only downloaded once
+        self.pending = {}
+
+    def link(self, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    # puts an already archived copy of `key` at save_path, False if there isn't one
+    def link_known(self, key, save_path):
+        known_path = store.get_media_path(self.db, key)
+        if known_path is None:
+            return False
+        self.link(known_path, save_path)
+        return True
+
+    # save_path if the media ends up there (already there, linked, or downloaded with `download()`), else None
+    async def fetch(self, key, save_path, download):
+        if os.path.exists(save_path) or self.link_known(key, save_path):
+            return save_path
+        if key in self.pending:
+            await self.pending[key].wait()
+            # (the other download may have been to this very path, the same forward twice in one chat)
+            return save_path if os.path.exists(save_path) or self.link_known(key, save_path) else None
+        self.pending[key] = asyncio.Event()
+        try:
+            path = await download()
+            if path is not None:
+                await self.add(key, path)
+            return path
+        finally:
+            self.pending.pop(key).set()
+
+    async def add(self, key, path):
+        sha256 = await asyncio.to_thread(file_sha256, path)
+        canonical = store.add_media(self.db, key, sha256, path)
+        if canonical != path:
+            os.remove(path)
+            self.link(canonical, path)
+
+    def close(self):
+        self.db.close()
+
+# the saved path, or None if the file couldn't be downloaded. one bad file (an rpc error, a dropped connection, a
+# timeout) is logged and its message is archived without it, instead of failing the whole chat.
+# telethon writes into save_path.part, which is only renamed to save_path once it's complete, so a file at save_path
+# is always a finished one even after a ctrl-c or a crash mid-download (a leftover .part is just overwritten)
+async def download_with_backoff(tgc: TelegramClient, media, save_path, limiter: RequestLimiter, thumb=None):
+    part_path = save_path + ".part"
+    for _ in range(MAX_FLOOD_RETRIES):
+        async with limiter:
+            try:
+                if thumb is not None:
+                    path = await tgc.download_media(media, file=part_path, thumb=thumb)
+                else:
+                    path = await tgc.download_media(media, file=part_path)
+            except FloodWaitError as e:
+                print(f"FloodWait: pausing requests for {e.seconds}s")
+                limiter.gate.hit(e.seconds)
+                continue
+            except (RPCError, OSError, asyncio.TimeoutError, ValueError) as e:
+                print(f"couldn't download {save_path} ({e.__class__.__name__}: {e}), skipping it")
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                return None
+        if path is None:
+            return None
+        os.replace(path, save_path)
+        return save_path
+    print(f"giving up on {save_path} after {MAX_FLOOD_RETRIES} FloodWaits")
+    return None
+
+# downloads the photo/document of every message, as many at a time as the limiter allows.
+# returns {msg.id: (media path, thumb path)}, relative to the chat folder, for everything that downloaded.
+# with thumbs_only, photos only get their thumbnail and documents aren't downloaded at all, the media path is then
+# where the full file goes once it's fetched (python main.py --fetch-full)
+async def download_chat_media(chat_dict, tgc: TelegramClient, out: ChatOutput, limiter: RequestLimiter,
+                              dedup: MediaDedup, thumbs_only=False):
+    msgs = [msg for msg in chat_dict.values() if msg.document is not None or msg.photo is not None]
+
+    async def _fetch(media, key, save_path, thumb=None):
+        path = await dedup.fetch(key, save_path, lambda: download_with_backoff(tgc, media, save_path, limiter, thumb))
+        return os.path.relpath(path, out.name) if path else None
+
+    async def _download(msg):
+        save_path = media_save_path(msg, out)
+        if msg.document is not None:
+            if thumbs_only:
+                return msg.id, (os.path.relpath(save_path, out.name), None)
+            path = await _fetch(msg.document, f"doc{msg.document.id}", save_path)
+            return msg.id, (path, None) if path else None
+        thumb = pick_thumb(msg.photo) if thumbs_only else None
+        if thumb is None:
+            path = await _fetch(msg.photo, f"photo{msg.photo.id}", save_path)
+            return msg.id, (path, None) if path else None
+        thumb_path = await _fetch(msg.photo, f"photo{msg.photo.id}:{thumb.type}", thumb_save_path(msg, thumb, out),
+                                  thumb)
+        return msg.id, (os.path.relpath(save_path, out.name), thumb_path) if thumb_path else None
+
+    paths = {}
+    for msg_id, path in await asyncio.gather(*[_download(msg) for msg in msgs]):
+        if path is not None:
+            paths[msg_id] = path
+    if msgs:
+        print(f"{out.name}: got media for {len(paths)}/{len(msgs)} messages")
+    return paths
+
+# renders one stored record (see store.py). `parent` is the record it replies to, if it's in the archive
+def fmt_msg_html(record, names, parent=None):
+    _text = record["text"]
+    _from = names.get(record["sender_id"])
+    _date = datetime.fromisoformat(record["date"])
+    reply_to = record["reply_to"]
+    if reply_to is not None:
+        if parent is not None:
+            _reply_txt = parent["text"]
+            _reply_from = names.get(parent["sender_id"])
+        else:
+            # the parent is older than anything archived (MAX_MESSAGES_PER_CHAT)
+            _reply_txt = f"(message #{reply_to})"
+            _reply_from = ""
+
+    # media that failed to download just has no path. a thumbnail links to the full photo
+    h_img = ""
+    if record["media_type"] == "photo" and record["thumb_path"] is not None:
+        h_img = f"<a href='{record['media_path']}'><img src='{record['thumb_path']}'/></a>"
+    elif record["media_type"] == "photo":
+        h_img = f"<img src='{record['media_path']}'/>"
     h_from = f"<span class='from'>@{_from}</span>"
     h_time = f"<span class='time'>({_date})</span>"
     if reply_to is not None:
         h_quote = f"<span class='quote'><br>&nbsp;| {_reply_from}&nbsp;{_reply_txt}</span>"
     else:
         h_quote = ""
-    if _document is not None:
-        h_doc = f"<br><span class='doc'>&nbsp;<a href={doc_path}> attachment </a> </span>"
+    if record["media_type"] == "document":
+        h_doc = f"<br><span class='doc'>&nbsp;<a href={record['media_path']}> attachment </a> </span>"
     else:
         h_doc = ""
     h_txt = f"<br><span class='text'>{_text}</span>"
     return f"<div class='msg'>{h_img}<p>{h_from}&nbsp;{h_time}{h_quote}{h_txt}{h_doc}</p></div>"
 
-async def fmt_chat_html(chat_name, chat_dict, tgc: TelegramClient):
+def fmt_chat_header(chat_name):
     header = f"<html><title>{chat_name}</title>"
     chat_html = "<style>img {max-height:250px; max-width:250px;} \
                 .from {font-weight: bold;}\
                 .msg {border-style: solid;border-width: 1px;}\
-                .quote, .doc, .time {font-style: italic;}</style>"
-    msges_html = ""
-    for v in chat_dict.values():
-        msges_html = msges_html + await fmt_msg_html(v, chat_dict, tgc)
+                .quote, .doc, .time, .nav {font-style: italic;}</style>"
+    return header + chat_html
+
+# writes messages straight to disk as they're formatted, split into pages of `per_page` messages:
+# chat.html, chat_2.html, chat_3.html, ... each linking to the previous and next one.
+# reopening an existing page (next run) drops its closing tag and carries on appending to it
+class ChatHtmlWriter:
+    def __init__(self, _name, page=1, page_msgs=0, per_page=None):
+        self._name = _name
+        self.page = page
+        self.page_msgs = page_msgs
+        self.per_page = per_page or DEFAULT_MESSAGES_PER_PAGE
+        self.f = None
+
+    def page_filename(self, page):
+        return self._name + ".html" if page == 1 else f"{self._name}_{page}.html"
+
+    def _open(self):
+        path = os.path.join(self._name, self.page_filename(self.page))
+        if os.path.exists(path):
+            strip_closing_tag(path)
+            self.f = open(path, 'a')
+            return
+        self.f = open(path, 'w')
+        self.f.write(fmt_chat_header(self._name))
+        if self.page > 1:
+            self.f.write(f"<p class='nav'><a href='{self.page_filename(self.page - 1)}'>&lt; previous page</a></p>")
+
+    def _next_page(self):
+        self.f.write(f"<p class='nav'><a href='{self.page_filename(self.page + 1)}'>next page &gt;</a></p></html>")
+        self.f.close()
+        self.page += 1
+        self.page_msgs = 0
+        self._open()
+
+    def write(self, msg_html):
+        if self.f is None:
+            self._open()
+        if self.page_msgs >= self.per_page:
+            self._next_page()
+        self.f.write(msg_html)
+        self.page_msgs += 1
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    # bytes written to the current page so far, without the closing tag. None before anything was written
+    def size(self):
+        if self.f is None:
+            return None
+        self.f.flush()
+        return os.fstat(self.f.fileno()).st_size
+
+    def close(self):
+        if self.f is not None:
+            self.f.write("</html>")
+            self.f.close()
+            self.f = None
+
+# deletes every html page of a chat (chat.html, chat_2.html, ...)
+def remove_pages(_name):
+    page = 1
+    while os.path.exists(os.path.join(_name, ChatHtmlWriter(_name).page_filename(page))):
+        os.remove(os.path.join(_name, ChatHtmlWriter(_name).page_filename(page)))
+        page += 1
+
+# the html and jsonl are appended to before the state file is saved, so a run that dies in between leaves a chunk in
+# them that the next run fetches again. cutting both back to the sizes saved with the state drops that chunk
+# (and any page it started) first
+def rewind_outputs(_name, state):
+    writer = ChatHtmlWriter(_name)
+    if state.get("page_bytes") is not None:
+        truncate_to(os.path.join(_name, writer.page_filename(state["page"])), state["page_bytes"])
+        page = state["page"] + 1
+        while os.path.exists(os.path.join(_name, writer.page_filename(page))):
+            os.remove(os.path.join(_name, writer.page_filename(page)))
+            page += 1
+    if state.get("jsonl_bytes") is not None:
+        truncate_to(os.path.join(_name, store.JSONL_NAME), state["jsonl_bytes"])
+
+def truncate_to(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+
+def strip_closing_tag(path):
+    closing = b"</html>"
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(max(0, end - len(closing)))
+        if f.read() == closing:
+            f.seek(end - len(closing))
+            f.truncate()
+
+# per-chat record of the newest message id already in the archive (so the next run only asks for newer ones)
+# and where the html pages are at
+def state_path(_name):
+    return os.path.join(_name, "archive_state.json")
 
-    return header + chat_html + msges_html + "</html>"
+def load_state(_name):
+    state = {"last_id": 0, "page": 1, "page_msgs": 0}
+    if os.path.exists(state_path(_name)):
+        with open(state_path(_name), 'r') as f:
+            state.update(json.load(f))
+    return state
 
-async def main():
-    global IMG_DIR, DOC_DIR
+def save_state(_name, state):
+    # write + rename so a crash can't leave a truncated state file
+    tmp = state_path(_name) + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path(_name))
+
+# messages after last_id, oldest first. on the first run with a limit, starts from the limit-th newest message
+# so MAX_MESSAGES_PER_CHAT still means "the latest N messages".
+# pages through get_messages itself (rather than iter_messages) so every request goes through the shared limiter
+async def iter_new_messages(tgc: TelegramClient, entity, last_id, limiter: RequestLimiter, limit=None):
+    if not last_id and limit:
+        async with limiter:
+            oldest = await tgc.get_messages(entity, limit=1, add_offset=limit - 1)
+        last_id = oldest[0].id - 1 if oldest else 0
+    remaining = limit
+    while remaining is None or remaining > 0:
+        batch_size = MESSAGES_PER_REQUEST if remaining is None else min(MESSAGES_PER_REQUEST, remaining)
+        async with limiter:
+            batch = await tgc.get_messages(entity, limit=batch_size, min_id=last_id, reverse=True)
+        for msg in batch:
+            yield msg
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].id
+        if remaining is not None:
+            remaining -= len(batch)
+
+# streams a chat into its store and html pages: messages are pulled CHUNK_MESSAGES at a time, that chunk's media is
+# downloaded concurrently, then the chunk is saved as records (one transaction) and each record is rendered and
+# written out, and the chunk is dropped. replies are quoted by looking the parent up in the store, so memory doesn't
+# grow with the size of the chat and a reply to a message from an earlier run still gets its quote.
+# the state file is updated after every chunk (with the size of the html and jsonl at that point, see
+# rewind_outputs), so an interrupted run resumes without duplicating messages
+async def archive_chat(tgc: TelegramClient, entity, out: ChatOutput, senders: SenderCache, limiter: RequestLimiter,
+                       dedup: MediaDedup):
+    _name = out.name
+    # html from before there was a state file (or from a run that died before its first chunk was saved) holds
+    # messages we'd fetch again from the start, so it's rewritten rather than appended to
+    if not os.path.exists(state_path(_name)):
+        remove_pages(_name)
+    state = load_state(_name)
+    rewind_outputs(_name, state)
+    print(f"{_name}: getting messages" + (f" newer than #{state['last_id']}" if state["last_id"] else ""))
+    db = store.open_store(_name)
+    for sender_id, username in store.get_sender_names(db).items():
+        senders.names.setdefault(sender_id, username)
+    writer = ChatHtmlWriter(_name, state["page"], state["page_msgs"], MESSAGES_PER_PAGE)
+    chunk = {}
+    num_msgs = 0
+
+    async def _flush():
+        nonlocal num_msgs
+        media_paths = await download_chat_media(chunk, tgc, out, limiter, dedup, THUMBNAILS_ONLY)
+        records = [store.msg_record(msg, media_paths) for msg in chunk.values()]
+        chunk_senders = {msg.sender_id: await senders.username(msg) for msg in chunk.values()}
+        store.add_messages(db, records, chunk_senders)
+        if EXPORT_JSONL:
+            store.append_jsonl(_name, records)
+            state["jsonl_bytes"] = os.path.getsize(os.path.join(_name, store.JSONL_NAME))
+        for record in records:
+            parent = store.get_message(db, record["reply_to"]) if record["reply_to"] is not None else None
+            writer.write(fmt_msg_html(record, senders.names, parent))
+        num_msgs += len(chunk)
+        state.update(last_id=max(chunk), page=writer.page, page_msgs=writer.page_msgs, page_bytes=writer.size())
+        save_state(_name, state)
+        chunk.clear()
+
+    try:
+        async for msg in iter_new_messages(tgc, entity, state["last_id"], limiter, MAX_MESSAGES_PER_CHAT):
+            chunk[msg.id] = msg
+            if len(chunk) >= CHUNK_MESSAGES:
+                await _flush()
+        if chunk:
+            await _flush()
+    finally:
+        writer.close()
+        db.close()
+    return num_msgs
+
+# throws away a chat's html pages and renders them again from its store, no telegram connection needed
+# (after changing MESSAGES_PER_PAGE or the formatting, say)
+def rebuild_chat_html(_name):
+    remove_pages(_name)
+    writer = ChatHtmlWriter(_name, per_page=MESSAGES_PER_PAGE)
+    db = store.open_store(_name)
+    names = store.get_sender_names(db)
+    num_msgs = 0
+    try:
+        for record in store.iter_records(db):
+            parent = store.get_message(db, record["reply_to"]) if record["reply_to"] is not None else None
+            writer.write(fmt_msg_html(record, names, parent))
+            num_msgs += 1
+        page_bytes = writer.size()
+    finally:
+        writer.close()
+        db.close()
+    state = load_state(_name)
+    state.update(page=writer.page, page_msgs=writer.page_msgs, page_bytes=page_bytes)
+    save_state(_name, state)
+    print(f"Rendered {num_msgs} messages to {_name}/")
+
+# the "on request" half of THUMBNAILS_ONLY: downloads the full-size file of every archived message whose media
+# isn't on disk yet. the html already links there, so nothing needs re-rendering
+async def fetch_full_media(tgc: TelegramClient, entity, out: ChatOutput, limiter: RequestLimiter, dedup: MediaDedup):
+    db = store.open_store(out.name)
+    missing = [r["id"] for r in store.iter_media_records(db)
+               if not os.path.exists(os.path.join(out.name, r["media_path"]))]
+    db.close()
+    print(f"{out.name}: fetching {len(missing)} full-size media files")
+    for i in range(0, len(missing), MESSAGES_PER_REQUEST):
+        async with limiter:
+            msgs = await tgc.get_messages(entity, ids=missing[i:i + MESSAGES_PER_REQUEST])
+        # deleted messages come back as None
+        await download_chat_media({msg.id: msg for msg in msgs if msg is not None}, tgc, out, limiter, dedup)
+
+# the output folder of every chat, keeping the plain name for chats that don't collide with another one
+def chat_outputs(chats):
+    names = Counter(ChatOutput(chat.name).name for chat in chats)
+    return [ChatOutput(chat.name, chat.id if names[ChatOutput(chat.name).name] > 1 else None) for chat in chats]
+
+# one chat start to finish. chats run concurrently, sharing the client, the sender cache, the request limiter
+# and the media dedup index
+async def archive_target(tgc: TelegramClient, chat, senders: SenderCache, limiter: RequestLimiter, dedup: MediaDedup,
+                         fetch_full=False, out=None):
+    out = out or ChatOutput(chat.name)
+    print("Found chat: " + chat.name)
+    if not os.path.exists(out.name):
+        os.mkdir(out.name)
+    if fetch_full:
+        return await fetch_full_media(tgc, chat.entity, out, limiter, dedup)
+    await senders.prefetch(chat.entity, limiter)
+    num_msgs = await archive_chat(tgc, chat.entity, out, senders, limiter, dedup)
+    if num_msgs:
+        print(f"Wrote {num_msgs} messages from chat: {out.name} to {out.name}/")
+    else:
+        print(f"No new messages in: {chat.name}")
+
+async def main(fetch_full=False):
     # pull user configs from config.py or ask the user manually
     phone = TG_PHONE_NUMBER if TG_PHONE_NUMBER is not None else input("Enter your phone number: ")
     api_id = TG_API_KEY if TG_API_KEY is not None else input("Enter your api id: ")
@@ -78,39 +549,30 @@ async def main():
     # ask user for chats to archive, or pull from config.py if filled out
     if not CHAT_TARGETS:
         _prompt = "Enter chat name(s) to archive, comma-separated: "
-        targets = [s.strip(' ').lower() for s in input(_prompt)]
+        targets = [s.strip(' ').lower() for s in input(_prompt).split(',')]
     else:
-        targets = CHAT_TARGETS
-
-    # get all messages from chats
-    chats = {}
-    chat_ids = await tgc.get_dialogs()
-    for chat in chat_ids:
-        _chat_name = chat.name.lower()
-        if _chat_name in targets:
-            print("Found chat: " + chat.name)
-            print("Getting messages...")
-            msg_list = [msg for msg in await tgc.get_messages(_chat_name, MAX_MESSAGES_PER_CHAT)]
-            msges = {}
-            for msg in msg_list:
-                msges[msg.id] = msg
-            chats[_chat_name] = msges
-
-    # fmt as html and save to directory with images and files
-    for chat_name, chat_dict in chats.items():
-        print("Formatting chat: " + chat_name)
-        _name = chat_name.replace(' ', '_')
-        if not os.path.exists(_name):
-            os.mkdir(_name)
-        IMG_DIR = os.path.join(_name, "images")
-        DOC_DIR = os.path.join(_name, "documents")
-
-        html = await fmt_chat_html(_name, chat_dict, tgc)
-        # saves to ./chat_name/chat_name.html
-        filename  = os.path.join(_name, _name + ".html")
-        with open(filename, 'w') as f:
-            f.write(html)
-        print(f"Wrote chat: {_name} to file {filename}")
+        targets = [s.lower() for s in CHAT_TARGETS]
+
+    # stream every target chat to ./chat_name/chat_name.html (+ _2.html, _3.html, ... for big chats), all at once
+    senders = SenderCache(tgc, SENDER_CACHE_FILE)
+    limiter = RequestLimiter(MAX_PARALLEL_DOWNLOADS or DEFAULT_PARALLEL_DOWNLOADS)
+    dedup = MediaDedup()
+    chats = [chat for chat in await tgc.get_dialogs() if chat.name.lower() in targets]
+    results = await asyncio.gather(*[archive_target(tgc, chat, senders, limiter, dedup, fetch_full, out)
+                                     for chat, out in zip(chats, chat_outputs(chats))], return_exceptions=True)
+    # one chat failing doesn't take the others down with it
+    for chat, result in zip(chats, results):
+        if isinstance(result, Exception):
+            print(f"failed to archive {chat.name}: {result!r}")
+
+    senders.save()
+    dedup.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # python main.py --rebuild-html chat_folder [chat_folder ...]
+    # python main.py --fetch-full    (full-size media for chats archived with THUMBNAILS_ONLY)
+    if sys.argv[1:2] == ["--rebuild-html"]:
+        for _name in sys.argv[2:]:
+            rebuild_chat_html(_name.rstrip('/'))
+    else:
+        asyncio.run(main(fetch_full=sys.argv[1:2] == ["--fetch-full"]))
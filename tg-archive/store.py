@@ -0,0 +1,123 @@
+import os
+import json
+import sqlite3
+
+# every archived message is kept as a compact record in chat_name/messages.db, the html pages are rendered from it.
+# a record is {id, date, sender_id, reply_to, text, media_type, media_path, thumb_path}: date is iso 8601 (utc),
+# media_type is "photo" / "document" / None and the paths are relative to the chat folder. thumb_path is only set
+# in THUMBNAILS_ONLY mode, where media_path is where the full file goes once it's fetched.
+# id is the primary key and date / sender / reply are indexed, so reply quoting (and any query you want to run
+# yourself with the sqlite3 cli) doesn't have to scan the chat
+DB_NAME = "messages.db"
+JSONL_NAME = "messages.jsonl"
+
+RECORD_FIELDS = ("id", "date", "sender_id", "reply_to", "text", "media_type", "media_path", "thumb_path")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    sender_id INTEGER,
+    reply_to INTEGER,
+    text TEXT,
+    media_type TEXT,
+    media_path TEXT,
+    thumb_path TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender_id);
+CREATE INDEX IF NOT EXISTS messages_reply ON messages (reply_to);
+CREATE TABLE IF NOT EXISTS senders (
+    id INTEGER PRIMARY KEY,
+    username TEXT
+);
+"""
+
+def open_store(_name):
+    db = sqlite3.connect(os.path.join(_name, DB_NAME))
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    # dbs from before thumbnails were a thing
+    if "thumb_path" not in [row["name"] for row in db.execute("PRAGMA table_info(messages)")]:
+        db.execute("ALTER TABLE messages ADD COLUMN thumb_path TEXT")
+    return db
+
+# the message -> record conversion, media_paths is {msg.id: (media path, thumb path)} from the downloads
+def msg_record(msg, media_paths):
+    media_path, thumb_path = media_paths.get(msg.id, (None, None))
+    media_type = None
+    if media_path is not None:
+        media_type = "document" if msg.document is not None else "photo"
+    return {"id": msg.id, "date": msg.date.isoformat(), "sender_id": msg.sender_id, "reply_to": msg.reply_to_msg_id,
+            "text": msg.text, "media_type": media_type, "media_path": media_path, "thumb_path": thumb_path}
+
+# one transaction per chunk, so the db never holds half a chunk. a None sender id is skipped: as an INTEGER PRIMARY
+# KEY it would get an arbitrary rowid and could overwrite a real sender's name
+def add_messages(db, records, senders=None):
+    with db:
+        db.executemany(f"INSERT OR REPLACE INTO messages ({', '.join(RECORD_FIELDS)}) "
+                       f"VALUES ({', '.join('?' * len(RECORD_FIELDS))})",
+                       [tuple(r[k] for k in RECORD_FIELDS) for r in records])
+        if senders:
+            db.executemany("INSERT OR REPLACE INTO senders VALUES (?, ?)",
+                           [(sender_id, name) for sender_id, name in senders.items() if sender_id is not None])
+
+def get_message(db, msg_id):
+    row = db.execute("SELECT * FROM messages WHERE id = ?", (msg_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+# records whose media is in the archive, for fetching full-size files later
+def iter_media_records(db):
+    for row in db.execute("SELECT * FROM messages WHERE media_path IS NOT NULL ORDER BY id"):
+        yield dict(row)
+
+def get_sender_names(db):
+    return {row["id"]: row["username"] for row in db.execute("SELECT id, username FROM senders")}
+
+# oldest first, streamed straight from the cursor
+def iter_records(db):
+    for row in db.execute("SELECT * FROM messages ORDER BY id"):
+        yield dict(row)
+
+# the same records, one json object per line, for tools that would rather not talk to sqlite
+def append_jsonl(_name, records):
+    with open(os.path.join(_name, JSONL_NAME), 'a') as f:
+        for r in records:
+            f.write(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+# shared by every chat (media.db next to the chat folders). `media` maps a telegram media key (forwards keep the
+# photo/document id, so a forward is found before downloading anything) to the sha256 of its file, `blobs` maps a
+# sha256 to the first file saved with that content (re-uploads of the same bytes get hardlinked to it)
+MEDIA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    key TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+"""
+
+def open_media_index(path):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(MEDIA_SCHEMA)
+    return db
+
+# a file that already holds this media, if it's still on disk
+def get_media_path(db, key):
+    row = db.execute("SELECT blobs.path FROM media JOIN blobs USING (sha256) WHERE media.key = ?", (key,)).fetchone()
+    return row[0] if row is not None and os.path.exists(row[0]) else None
+
+# records a freshly downloaded file, returns the file that should hold its content:
+# an earlier one with the same sha256 if there is one, otherwise `path` itself
+def add_media(db, key, sha256, path):
+    with db:
+        db.execute("INSERT OR REPLACE INTO media VALUES (?, ?)", (key, sha256))
+        row = db.execute("SELECT path FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is not None and row[0] != path and os.path.exists(row[0]):
+            return row[0]
+        db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (sha256, path))
+    return path